@@ -0,0 +1,88 @@
+"""
+Activation functions shared by R2 models and ELM
+
+All of them take optional out buffer (it can be x itself, for in-place evaluation) and do not allocate temporaries of
+the size of x. They do not overflow for large |x|.
+"""
+
+import numpy as np
+from scipy.special import expit
+
+
+def sigmoid(x, out=None):
+    return expit(x, out=out)
+
+
+def tanh(x, out=None):
+    # Same function as 2/(1 + exp(x)) - 1 (note the sign), which is -tanh(x/2)
+    out = np.multiply(x, -0.5, out=out)
+    return np.tanh(out, out=out)
+
+
+def rbf(x, out=None):
+    # Centered by mean of the passed batch
+    out = np.subtract(x, np.mean(x, axis=0), out=out)
+    np.square(out, out=out)
+    np.negative(out, out=out)
+    return np.exp(out, out=out)
+
+
+def rbf_01(x, out=None):
+    out = np.square(x, out=out)
+    out *= -0.5
+    return np.exp(out, out=out)
+
+
+activations = {'sigmoid': sigmoid, 'tanh': tanh, 'rbf': rbf, '01_rbf': rbf_01}
+
+
+def elm_sigmoid(X, W, B):
+    H = X.dot(W)
+    H += B
+    return sigmoid(H, out=H)
+
+
+def elm_vectorized_rbf(X, W, B):
+    # exp(-B * (-2 X W + |W|^2 + |X|^2)), where only the norm of the first sample of X is used
+    # (kept from the original implementation)
+    H = X.dot(W)
+    H *= -2.
+    H += np.sum(np.multiply(W, W), axis=0)
+    H += np.dot(X[0], X[0])
+    H *= B
+    np.negative(H, out=H)
+    return np.exp(H, out=H)
+
+
+if __name__ == "__main__":
+    import timeit
+
+    def old_sigmoid(x):
+        return 1.0 / (1.0 + np.exp(-x))
+
+    def old_tanh(x):
+        return 2. / (1. + np.exp(x)) - 1.
+
+    def old_rbf(x):
+        return np.exp(-np.power((x - np.mean(x, axis=0)), 2))
+
+    def old_01_rbf(x):
+        return np.exp(-(np.power(x, 2)/2))
+
+    x = np.random.RandomState(0).normal(scale=3, size=(10000, 500))
+    buffer = np.empty_like(x)
+
+    for name, old in [('sigmoid', old_sigmoid), ('tanh', old_tanh), ('rbf', old_rbf), ('01_rbf', old_01_rbf)]:
+        new = activations[name]
+        assert np.allclose(old(x), new(x, out=buffer))
+        t_old = min(timeit.repeat(lambda: old(x), number=5, repeat=3)) / 5
+        t_new = min(timeit.repeat(lambda: new(x, out=buffer), number=5, repeat=3)) / 5
+        print("{0}: old {1:2.4f} s, new {2:2.4f} s".format(name, t_old, t_new))
+
+    """
+        results on 10000 x 500 float64 (new ones write into preallocated buffer, sigmoid gains stability not speed):
+            sigmoid: old 0.0492 s, new 0.0524 s
+            tanh: old 0.0402 s, new 0.0228 s
+            rbf: old 0.0671 s, new 0.0358 s
+            01_rbf: old 0.0425 s, new 0.0164 s
+    """
@@ -2,62 +2,259 @@ import numpy as np
 from sklearn.preprocessing import MinMaxScaler, LabelBinarizer
 from sklearn.base import BaseEstimator, clone
 from scipy import linalg as la
+from activations import elm_sigmoid, elm_vectorized_rbf
 
-def _elm_vectorized_rbf(X, W, B):
-    WS = np.array([np.sum(np.multiply(W,W), axis=0)])
-    XS = np.array([np.sum(np.multiply(X,X), axis=1)]).T[0,:]
-    return np.exp(-np.multiply(B, -2*X.dot(W) + WS + XS))
-
-
-def _elm_sigmoid(X, W, B):
-    return 1.0/(1.0  + np.exp(-(X.dot(W) + B)))
+def _ridge_cholesky(A, B, alpha):
+    """
+    Solves (A + alpha*I) x = B for symmetric positive semidefinite A by Cholesky factor-and-solve, modifies A
+    """
+    A.flat[::A.shape[0] + 1] += alpha
+    try:
+        return la.cho_solve(la.cho_factor(A), B)
+    except la.LinAlgError:
+        # Numerically not positive definite (e.g. huge rbf activations), fall back to LU
+        return la.solve(A, B)
 
 
 class ELM(BaseEstimator):
 
-    def __init__(self, h=60, activation='linear', random_state=None, C=100):
+    def __init__(self, h=60, activation='linear', random_state=None, C=100, solver='auto', dtype=np.float64):
+        """
+        @param dtype float type of hidden layer weights, activations and solves
+        @param solver 'cholesky' solves h x h system H^T H + I/C, 'dual' solves n x n system H H^T + I/C (cheaper
+            when n < h), 'svd' decomposes H once so C can be changed afterwards by set_C, 'auto' picks cholesky
+            or dual by shape of H
+        """
         self.name = 'elm'
         self.h = h
         self.activation = activation
         self.random_state = random_state
         self.C = C
+        self.solver = solver
+        self.dtype = dtype
 
         assert self.activation in ['rbf', 'sigmoid', 'linear']
+        assert self.solver in ['auto', 'cholesky', 'svd', 'dual']
 
-    def fit(self, X, y):
-
+    def _init_hidden(self, X, y):
         if self.random_state is None:
             self.random_state = np.random.RandomState(np.random.randint(0, np.iinfo(np.int32).max))
         elif type(self.random_state) == int:
             self.random_state = np.random.RandomState(self.random_state)
 
         self.lb = LabelBinarizer()
-        self.W = self.random_state.normal(size=(X.shape[1], self.h))
-        self.B = self.random_state.normal(size=self.h)
-
-        if self.activation == 'rbf':
-            H = _elm_vectorized_rbf(X, self.W, self.B)
-        elif self.activation == 'sigmoid':
-            H = _elm_sigmoid(X, self.W, self.B)
-        else :
-            H = X.dot(self.W)
+        self.W = self.random_state.normal(size=(X.shape[1], self.h)).astype(self.dtype)
+        self.B = self.random_state.normal(size=self.h).astype(self.dtype)
+        self.HtH_, self.HtT_, self.P_ = None, None, None
 
         self.lb.fit(y)
 
-        lam = np.eye(H.shape[1]) * (1./self.C)
-        H_inv = np.linalg.inv(H.T.dot(H) + lam)
-        self.beta = H_inv.dot(H.T.dot(self.lb.transform(y)))
+    def fit(self, X, y):
+        self._init_hidden(X, y)
+
+        H = self._hidden(X)
+        T = self._targets(y)
+
+        solver = self.solver
+        if solver == 'auto':
+            solver = 'dual' if H.shape[0] < H.shape[1] else 'cholesky'
+
+        self.svd_ = None
+        if solver == 'cholesky':
+            # Normal equations are kept, so training can be continued by partial_fit
+            self.HtH_, self.HtT_ = H.T.dot(H), H.T.dot(T)
+            self._solve_gram()
+        elif solver == 'dual':
+            self.beta = H.T.dot(_ridge_cholesky(H.dot(H.T), T, 1./self.C))
+        else:
+            U, s, Vt = la.svd(H, full_matrices=False)
+            self.svd_ = (s, Vt, U.T.dot(T))
+            self.beta = self._svd_beta(self.C)
+            self._gram_from_svd()
 
         return self
 
+    def partial_fit(self, X, y, classes=None):
+        """
+        Adds chunk (X, y) to accumulated H^T H and H^T T and solves for beta, so model is usable after every call.
+        Memory does not depend on number of seen samples.
 
-    def decision_function(self, X):
+        @param classes all labels that can appear, required on the first call
+        """
+        if getattr(self, 'HtH_', None) is None:
+            if getattr(self, 'beta', None) is not None:
+                raise ValueError("partial_fit can not continue model fitted with dual solver")
+            if classes is None:
+                raise ValueError("classes have to be passed on the first call to partial_fit")
+            self._init_hidden(X, classes)
+
+        self._accumulate(X, y)
+        self._solve_gram()
+
+        return self
+
+    def fit_stream(self, X, y=None, classes=None, batch_size=1000):
+        """
+        Fits on data streamed in chunks, never materializing whole H, solves once at the end
+
+        @param X array-like sliced by rows into batch_size chunks (np.memmap is read chunk by chunk) with targets y,
+            or iterable of (X_chunk, y_chunk) pairs - then classes are required
+        """
+        if y is not None:
+            classes = np.unique(y) if classes is None else classes
+            chunks = ((X[i:i+batch_size], y[i:i+batch_size]) for i in xrange(0, X.shape[0], batch_size))
+        elif classes is None:
+            raise ValueError("classes have to be passed when fitting from iterable of chunks")
+        else:
+            chunks = X
+
+        self.HtH_, self.HtT_, self.svd_ = None, None, None
+        for id, (X_chunk, y_chunk) in enumerate(chunks):
+            X_chunk = np.asarray(X_chunk)
+            if id == 0:
+                self._init_hidden(X_chunk, classes)
+            self._accumulate(X_chunk, y_chunk)
+
+        if self.HtH_ is None:
+            raise ValueError("No data to fit")
+        self._solve_gram()
+
+        return self
+
+    def _accumulate(self, X, y):
+        H = self._hidden(X)
+        T = self._targets(y)
+        if self.HtH_ is None:
+            self.HtH_, self.HtT_ = H.T.dot(H), H.T.dot(T)
+        else:
+            self.HtH_ += H.T.dot(H)
+            self.HtT_ += H.T.dot(T)
+
+    def _solve_gram(self):
+        self.beta = _ridge_cholesky(self.HtH_.copy(), self.HtT_, 1./self.C)
+        self.svd_ = None
+        self.P_ = None
+
+    def _gram_from_svd(self):
+        # H^T H = V diag(s^2) V^T and H^T T = V diag(s) U^T T, cheap compared to the decomposition
+        s, Vt, UtT = self.svd_
+        self.HtH_, self.HtT_ = (Vt.T * s**2).dot(Vt), (Vt.T * s).dot(UtT)
+
+    def update(self, X, y):
+        """
+        Online sequential (OS-ELM) update - folds batch (X, y) into beta without revisiting old data
+
+        Keeps P = (H^T H + I/C)^-1 and for batch with k samples does rank-k recursive least squares step
+            G = P H^T (I + H P H^T)^-1,  beta <- beta + G (T - H beta),  P <- P - G H P
+        in O(k h^2 + k^3). P is computed from accumulated H^T H on the first update. y can contain only classes
+        seen when fitting.
+        """
+        if getattr(self, 'HtH_', None) is None:
+            raise ValueError("update requires model fitted with cholesky or svd solver, fit_path or partial_fit")
+
+        unseen = np.setdiff1d(np.unique(y), self.lb.classes_)
+        if len(unseen):
+            raise ValueError("update got classes not seen in fit: " + str(unseen))
+
+        if getattr(self, 'P_', None) is None:
+            A = self.HtH_.copy()
+            A.flat[::A.shape[0] + 1] += 1./self.C
+            self.P_ = la.cho_solve(la.cho_factor(A), np.eye(A.shape[0], dtype=A.dtype))
+
+        H = self._hidden(X)
+        T = self._targets(y)
+
+        PHt = self.P_.dot(H.T)
+        S = H.dot(PHt)
+        S.flat[::S.shape[0] + 1] += 1.
+        G = la.cho_solve(la.cho_factor(S), PHt.T).T
+
+        self.beta = self.beta + G.dot(T - H.dot(self.beta))
+        self.P_ -= G.dot(PHt.T)
+
+        # Normal equations stay in sync, so partial_fit can follow
+        self.HtH_ += H.T.dot(H)
+        self.HtT_ += H.T.dot(T)
+        self.svd_ = None
+
+        return self
+
+    def _svd_beta(self, C):
+        # H = U diag(s) Vt  =>  beta = V diag(s / (s^2 + 1/C)) U^T T
+        s, Vt, UtT = self.svd_
+        return Vt.T.dot((s / (s**2 + 1./C)).reshape(-1, 1) * UtT)
+
+    def fit_path(self, X, y, Cs, X_val=None, y_val=None, classes=None):
+        """
+        Fits ridge solutions for every C in Cs from a single SVD of H and keeps the best one as this model
+
+        Sets coef_path_ (solution per C), train_scores_path_ and, if X_val is passed, val_scores_path_ (accuracy
+        per C). Best C maximizes validation accuracy if available, training accuracy otherwise (first one on ties).
+        Afterwards score_path and set_C reuse the decomposition.
+
+        @param classes all labels of the problem (labels of y when None), e.g. when y is a part of training data
+            which can miss some class
+        """
+        self._init_hidden(X, y if classes is None else classes)
+
+        H = self._hidden(X)
+        T = self._targets(y)
+
+        U, s, Vt = la.svd(H, full_matrices=False)
+        self.svd_ = (s, Vt, U.T.dot(T))
+        self._gram_from_svd()
+        self.Cs_ = np.asarray(Cs, dtype=self.dtype)
+
+        # shrink[c, r] = s_r / (s_r^2 + 1/C_c), all solutions in one product
+        shrink = s / (s**2 + 1./self.Cs_.reshape(-1, 1))
+        self.coef_path_ = np.einsum('rh,crk->chk', Vt, shrink[:, :, np.newaxis] * self.svd_[2])
+
+        # H beta_c = U diag(s * shrink_c) U^T T
+        fitted = np.einsum('nr,crk->cnk', U, (s * shrink)[:, :, np.newaxis] * self.svd_[2])
+        self.train_scores_path_ = np.array([np.mean(self.lb.inverse_transform(f) == y) for f in fitted])
+
+        if X_val is not None:
+            self.val_scores_path_ = self.score_path(X_val, y_val)
+            best = np.argmax(self.val_scores_path_)
+        else:
+            best = np.argmax(self.train_scores_path_)
+
+        self.C = list(Cs)[best]
+        self.beta = self.coef_path_[best]
+
+        return self
+
+    def score_path(self, X, y):
+        """
+        Accuracy on (X, y) of every solution fitted by fit_path
+        """
+        H = self._hidden(X)
+        return np.array([np.mean(self.lb.inverse_transform(H.dot(beta)) == y) for beta in self.coef_path_])
+
+    def set_C(self, C):
+        """
+        Changes C of model fitted with solver='svd' reusing its decomposition of H (no refitting)
+        """
+        if getattr(self, 'svd_', None) is None:
+            raise ValueError("set_C requires model fitted with solver='svd'")
+        self.C = C
+        self.beta = self._svd_beta(C)
+        return self
+
+    def _targets(self, y):
+        return self.lb.transform(y).astype(self.dtype)
+
+    def _hidden(self, X):
+        X = np.asarray(X, dtype=self.dtype)
         if self.activation == 'rbf':
-            return _elm_vectorized_rbf(X, self.W, self.B).dot(self.beta)
+            return elm_vectorized_rbf(X, self.W, self.B)
         elif self.activation == 'sigmoid':
-            return _elm_sigmoid(X, self.W, self.B).dot(self.beta)
+            return elm_sigmoid(X, self.W, self.B)
         else :
-            return X.dot(self.W).dot(self.beta)
+            return X.dot(self.W)
+
+    def decision_function(self, X):
+        return self._hidden(X).dot(self.beta)
 
 
     def predict(self, X):
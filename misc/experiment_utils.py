@@ -1,9 +1,14 @@
 from optparse import OptionParser
 import cPickle
+import json
 import logging
 import os
+import sqlite3
 from config import c
 
+# Experiments of one results directory are rows of this SQLite file inside it
+RESULTS_DB = "results.sqlite"
+
 def get_logger(name, to_file=False):
     logger = logging.Logger(name=name, level=logging.INFO)
     ch = logging.StreamHandler()
@@ -92,17 +97,117 @@ def get_exp_fname(E):
     return E["config"]["experiment_name"] + ".experiment"
 
 
-def exp_done(E, dir_name):
-    directory = os.path.join(c["RESULTS_DIR"], dir_name)
-    path = os.path.join(directory, get_exp_fname(E))
-    return os.path.exists(path)
+def get_exp_names(exp_name, model_name, data_name, params):
+    """
+    @returns dir_name, experiment_name of experiment as saved by k_fold and extern_k_fold
+    """
+    dir_name = exp_name + '_' + model_name + '_' + data_name
+    return dir_name, dir_name + '_' + shorten_params(params)
 
 
-def save_exp(E, dir_name):
+def _results_db(dir_name, create=False):
+    """
+    @returns connection to results store of dir_name, None if it does not exist and create is False
+    """
     directory = os.path.join(c["RESULTS_DIR"], dir_name)
+    path = os.path.join(directory, RESULTS_DB)
+    if not create and not os.path.exists(path):
+        return None
     if not os.path.isdir(directory):
         os.makedirs(directory)
-    cPickle.dump(E, open(os.path.join(directory, get_exp_fname(E)), "w"))
+    # Many workers write to the same store, they wait for each other's transactions
+    db = sqlite3.connect(path, timeout=600)
+    db.execute("CREATE TABLE IF NOT EXISTS experiments (name TEXT PRIMARY KEY, row TEXT, experiment BLOB)")
+    return db
+
+
+def _exp_row(E):
+    """
+    Flat record of experiment for analysis: monitors, results and params merged (as scripts/to_csv.py did),
+    without stored models, arrays as lists
+    """
+    row = dict((k, v) for k, v in E["monitors"].iteritems() if k != "clf")
+    row.update(E["results"])
+    row.update(E["config"]["params"])
+    return json.dumps(row, default=lambda v: v.tolist() if hasattr(v, "tolist") else str(v))
+
+
+def _legacy_experiments(dir_name):
+    # Names of experiments saved as separate pickles (before the results store)
+    directory = os.path.join(c["RESULTS_DIR"], dir_name)
+    if not os.path.isdir(directory):
+        return []
+    return [f[0:-len(".experiment")] for f in os.listdir(directory) if f.endswith(".experiment")]
+
+
+def done_experiments(dir_name):
+    """
+    @returns set of names of experiments saved in dir_name (single query)
+    """
+    names = set(_legacy_experiments(dir_name))
+    db = _results_db(dir_name)
+    if db is not None:
+        names.update(name for name, in db.execute("SELECT name FROM experiments"))
+        db.close()
+    return names
+
+
+def exp_done(E, dir_name):
+    db = _results_db(dir_name)
+    if db is not None:
+        found = db.execute("SELECT 1 FROM experiments WHERE name = ?", (E["config"]["experiment_name"],)).fetchone()
+        db.close()
+        if found is not None:
+            return True
+    return os.path.exists(os.path.join(c["RESULTS_DIR"], dir_name, get_exp_fname(E)))
+
+
+def save_exp(E, dir_name):
+    """
+    Stores experiment in results store of dir_name in single transaction (replaces experiment of the same name)
+    """
+    row, blob = _exp_row(E), sqlite3.Binary(cPickle.dumps(E, cPickle.HIGHEST_PROTOCOL))
+    db = _results_db(dir_name, create=True)
+    with db:
+        db.execute("INSERT OR REPLACE INTO experiments VALUES (?, ?, ?)", (E["config"]["experiment_name"], row, blob))
+    db.close()
+
+
+def load_results(dir_name):
+    """
+    @returns dict experiment name -> flat record (see _exp_row) of all experiments in dir_name, without unpickling
+        stored experiments (except legacy pickle files)
+    """
+    results = {}
+    for name in _legacy_experiments(dir_name):
+        try:
+            E = cPickle.load(open(os.path.join(c["RESULTS_DIR"], dir_name, name + ".experiment"), "rb"))
+        except Exception:
+            print "Can not load", name
+            continue
+        results[name] = json.loads(_exp_row(E))
+
+    db = _results_db(dir_name)
+    if db is not None:
+        for name, row in db.execute("SELECT name, row FROM experiments"):
+            results[name] = json.loads(row)
+        db.close()
+    return results
+
+
+def load_exp(name, dir_name):
+    """
+    @returns whole stored experiment (with monitors and models), None if there is no such experiment
+    """
+    db = _results_db(dir_name)
+    if db is not None:
+        found = db.execute("SELECT experiment FROM experiments WHERE name = ?", (name,)).fetchone()
+        db.close()
+        if found is not None:
+            return cPickle.loads(str(found[0]))
+    path = os.path.join(c["RESULTS_DIR"], dir_name, name + ".experiment")
+    return cPickle.load(open(path, "rb")) if os.path.exists(path) else None
+
 
 def shorten_params(params):
     short_params = ""
@@ -0,0 +1,194 @@
+"""
+Experiment scheduler shared by scripts/fit_*.py
+
+Expands (model, param grid) specs over datasets into jobs, skips finished ones using one listing of each results
+directory, runs the rest in persistent worker processes longest first, kills and retries stuck workers and reports
+progress with throughput and ETA.
+"""
+
+import time
+import traceback
+from collections import deque
+from multiprocessing import Process, Pipe
+
+from sklearn.grid_search import ParameterGrid
+
+from experiment_utils import get_exp_names, done_experiments
+
+
+def estimate_cost(job):
+    """
+    Relative cost of a job, used only for ordering: samples * features * depth * hidden units, times number of
+    candidates fitted per layer when C is searched. Params missing in the grid take the model's defaults
+    """
+    default = job['model']()
+    params = dict((k, job['params'].get(k, getattr(default, k, None))) for k in ['depth', 'h', 'fit_c'])
+    cost = float(len(job['data'].target)) * job['data'].n_dim
+    cost *= (params['depth'] or 1) * (params['h'] or 1)
+    if params['fit_c'] == 'random':
+        cost *= 4
+    elif params['fit_c'] == 'random_exhaustive':
+        cost *= 7
+    return cost
+
+
+def gen_jobs(exp_params, datasets, runner, runner_kwargs=None):
+    """
+    @param exp_params list of dicts with 'model', 'params' (grid), 'exp_name', 'model_name' and optional 'kwargs'
+        (passed to runner, override runner_kwargs)
+    @param runner k_fold or extern_k_fold (any function with their signature)
+    """
+    for data in datasets:
+        for r in exp_params:
+            kwargs = dict(runner_kwargs or {}, **r.get('kwargs', {}))
+            for param in ParameterGrid(r['params']):
+                yield {'runner': runner, 'model': r['model'], 'params': param, 'data': data,
+                       'name': r['exp_name'], 'model_name': r['model_name'], 'kwargs': kwargs}
+
+
+def job_experiment_names(job):
+    """
+    @returns dir_name, names of all experiments saved by the job (one per depth or C when fitted at once)
+    """
+    params, kwargs = job['params'], job['kwargs']
+    if kwargs.get('all_depths', False):
+        variants = [dict(params, depth=d) for d in xrange(1, params['depth'] + 1)]
+    elif kwargs.get('Cs', None) is not None:
+        variants = [dict(params, C=C) for C in kwargs['Cs']]
+    else:
+        variants = [params]
+
+    names = [get_exp_names(job['name'], job['model_name'], job['data'].name, p) for p in variants]
+    return names[0][0], [name for _, name in names]
+
+
+def _run_job(job):
+    job['runner'](base_model=job['model'], params=job['params'], data=job['data'], exp_name=job['name'],
+                  model_name=job['model_name'], **job['kwargs'])
+
+
+def _worker(jobs, conn):
+    # Jobs are inherited by fork, only indices travel through the pipe. Every worker has its own pipe (no shared
+    # queue locks), so killing one can not block the others.
+    while True:
+        job_id = conn.recv()
+        if job_id is None:
+            break
+        try:
+            _run_job(jobs[job_id])
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+
+
+def run_experiments(exp_params, datasets, runner, n_jobs=2, runner_kwargs=None, timeout=None, max_retries=1,
+                    cost_fnc=estimate_cost, report_every=30, poll_interval=0.1):
+    """
+    Runs all not yet finished jobs of exp_params grids on datasets
+
+    @param timeout seconds after which worker running a job is killed (job is retried), None waits forever
+    @param max_retries how many times failed, killed or crashed job is run again
+    @returns list of (job, traceback or reason) of jobs which did not succeed
+    """
+    jobs = list(gen_jobs(exp_params, datasets, runner, runner_kwargs))
+
+    # Skip finished jobs, listing every results directory once
+    done_index = {}
+    todo = []
+    for job_id, job in enumerate(jobs):
+        dir_name, names = job_experiment_names(job)
+        if dir_name not in done_index:
+            done_index[dir_name] = done_experiments(dir_name)
+        if not all(name in done_index[dir_name] for name in names):
+            todo.append(job_id)
+
+    costs = dict((job_id, cost_fnc(jobs[job_id])) for job_id in todo)
+    pending = deque(sorted(todo, key=lambda job_id: -costs[job_id]))
+    print "Scheduling", len(pending), "jobs,", len(jobs) - len(pending), "already done"
+
+    workers = {}  # worker_id -> (process, connection)
+    running = {}  # worker_id -> (job_id, start time)
+    attempts = dict((job_id, 0) for job_id in todo)
+    failed = []
+    next_worker_id = [0]
+    stats = {'done': 0, 'done_cost': 0.}
+
+    def start_worker():
+        worker_id = next_worker_id[0]
+        next_worker_id[0] += 1
+        conn, worker_conn = Pipe()
+        process = Process(target=_worker, args=(jobs, worker_conn))
+        process.daemon = True
+        process.start()
+        worker_conn.close()
+        workers[worker_id] = (process, conn)
+
+    def finish(worker_id, error):
+        job_id, _ = running.pop(worker_id)
+        if error is None:
+            stats['done'] += 1
+            stats['done_cost'] += costs[job_id]
+            return
+        attempts[job_id] += 1
+        if attempts[job_id] <= max_retries:
+            print "Retrying job", job_id, "after:", error
+            pending.append(job_id)
+        else:
+            print "Job", job_id, "failed:", error
+            failed.append((jobs[job_id], error))
+            stats['done_cost'] += costs[job_id]
+
+    def kill(worker_id, reason):
+        process, conn = workers.pop(worker_id)
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        conn.close()
+        finish(worker_id, reason)
+        start_worker()
+
+    for _ in xrange(min(n_jobs, len(pending))):
+        start_worker()
+
+    total_cost = sum(costs.values())
+    start_time = last_report = time.time()
+
+    while pending or running:
+        for worker_id, (process, conn) in workers.items():
+            if worker_id not in running and pending:
+                job_id = pending.popleft()
+                running[worker_id] = (job_id, time.time())
+                conn.send(job_id)
+
+        time.sleep(poll_interval)
+
+        for worker_id, (process, conn) in workers.items():
+            if worker_id in running and conn.poll():
+                try:
+                    finish(worker_id, conn.recv())
+                except EOFError:
+                    pass  # worker died, handled below
+
+        now = time.time()
+        for worker_id, (job_id, job_start) in running.items():
+            if not workers[worker_id][0].is_alive():
+                kill(worker_id, "worker died (exit code " + str(workers[worker_id][0].exitcode) + ")")
+            elif timeout is not None and now - job_start > timeout:
+                kill(worker_id, "timeout after " + str(int(now - job_start)) + " s")
+
+        if now - last_report > report_every:
+            last_report = now
+            elapsed = now - start_time
+            rate = stats['done'] / elapsed * 60.
+            eta = elapsed / stats['done_cost'] * (total_cost - stats['done_cost']) if stats['done_cost'] else float('nan')
+            progress = "Done {0}/{1} jobs, {2:.1f} jobs/min, ETA {3:.0f} min, {4} running".format(
+                stats['done'], len(todo), rate, eta / 60., len(running))
+            print progress
+
+    for process, conn in workers.values():
+        conn.send(None)
+    for process, conn in workers.values():
+        process.join()
+
+    print "Finished", stats['done'], "jobs in", int(time.time() - start_time), "s,", len(failed), "failed"
+    return failed
@@ -0,0 +1,78 @@
+"""
+Publishing datasets once to memory-mapped files, so that Pool workers receive only a small handle
+"""
+
+import os
+import hashlib
+import numpy as np
+from config import c
+
+
+class MappedDataset(object):
+    """
+    Handle with the same fields as data_api datasets (name, data, target, n_dim, n_class).
+
+    Arrays are memory-mapped read-only on first access in each process. Pickling the handle sends only paths, and
+    all workers share one page-cache copy of the data.
+    """
+
+    def __init__(self, name, data_path, target_path, n_dim, n_class):
+        self.name = name
+        self.data_path = data_path
+        self.target_path = target_path
+        self.n_dim = n_dim
+        self.n_class = n_class
+        self._data = None
+        self._target = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.data_path, mmap_mode='r')
+        return self._data
+
+    @property
+    def target(self):
+        if self._target is None:
+            self._target = np.load(self.target_path, mmap_mode='r')
+        return self._target
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_data'] = None
+        state['_target'] = None
+        return state
+
+
+def _save_atomic(path, array):
+    tmp_path = path + ".tmp" + str(os.getpid())
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.rename(tmp_path, path)
+
+
+def publish_dataset(data, directory=None):
+    """
+    Writes data.data and data.target to .npy files (default CACHE_DIR/shared) and returns MappedDataset for them.
+    Files are named by content digest, so datasets sharing a name (e.g. tripled ones) do not collide and
+    already published data is not written again.
+    """
+    if directory is None:
+        directory = os.path.join(c["CACHE_DIR"], "shared")
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    X, Y = np.ascontiguousarray(data.data), np.ascontiguousarray(data.target)
+    digest = hashlib.md5()
+    for array in [X, Y]:
+        digest.update(str(array.dtype) + str(array.shape))
+        digest.update(array.view(np.uint8))
+    prefix = os.path.join(directory, data.name + "_" + digest.hexdigest()[0:12])
+
+    data_path, target_path = prefix + ".data.npy", prefix + ".target.npy"
+    if not os.path.exists(data_path):
+        _save_atomic(data_path, X)
+    if not os.path.exists(target_path):
+        _save_atomic(target_path, Y)
+
+    return MappedDataset(data.name, data_path, target_path, data.n_dim, data.n_class)
@@ -0,0 +1,87 @@
+"""
+Regression checks of scheduler.py, run by python -m unittest discover -s misc (or pytest). Needs config.py (see
+config.py.local), results directory is replaced by a temporary one
+"""
+
+import os, sys
+import shutil, tempfile
+import time
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scheduler
+from experiment_utils import save_exp, get_exp_names, done_experiments
+from config import c
+
+
+class _Data(object):
+    def __init__(self, name):
+        self.name, self.target, self.n_dim = name, np.zeros(10), 2
+
+
+class _Model(object):
+    # Defaults read by estimate_cost
+    def __init__(self, depth=3, h=10):
+        self.depth, self.h = depth, h
+
+
+def _runner(base_model, params, data, exp_name, model_name, log_path=None):
+    # h selects the behaviour: 1 saves experiment, 2 raises, 3 hangs
+    with open(log_path, "a") as f:
+        f.write(str(params['h']) + "\n")
+    if params['h'] == 2:
+        raise ValueError("failing job")
+    elif params['h'] == 3:
+        time.sleep(60)
+    dir_name, name = get_exp_names(exp_name, model_name, data.name, params)
+    save_exp({'config': {'experiment_name': name, 'params': params}, 'results': {'mean_acc': 1.},
+              'monitors': {}}, dir_name)
+
+
+class TestRunExperiments(unittest.TestCase):
+
+    def setUp(self):
+        self._config = dict(c)
+        c["RESULTS_DIR"] = tempfile.mkdtemp()
+        self.log_path = os.path.join(c["RESULTS_DIR"], "runs.log")
+
+    def tearDown(self):
+        shutil.rmtree(c["RESULTS_DIR"])
+        c.clear()
+        c.update(self._config)
+
+    def _run(self, max_retries):
+        exp_params = [{'model': _Model, 'params': {'h': [1, 2, 3, 4]}, 'exp_name': 'test', 'model_name': 'sched'}]
+        failed = scheduler.run_experiments(exp_params, [_Data('a'), _Data('b')], _runner, n_jobs=3,
+                                           runner_kwargs={'log_path': self.log_path}, timeout=1.,
+                                           max_retries=max_retries, poll_interval=0.01)
+        with open(self.log_path) as f:
+            runs = sorted(int(line) for line in f)
+        os.remove(self.log_path)
+        return failed, runs
+
+    def test_failures_retries_and_resume(self):
+        failed, runs = self._run(max_retries=1)
+        # Failing and hanging jobs of both datasets are run twice
+        self.assertEqual(runs, [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 4, 4])
+        self.assertEqual(sorted((job['data'].name, job['params']['h']) for job, _ in failed),
+                         [('a', 2), ('a', 3), ('b', 2), ('b', 3)])
+        for job, reason in failed:
+            self.assertTrue(("ValueError: failing job" if job['params']['h'] == 2 else "timeout") in reason)
+        self.assertEqual(len(done_experiments('test_sched_a')), 2)
+
+        # Finished experiments are skipped by the second run
+        failed, runs = self._run(max_retries=0)
+        self.assertEqual(runs, [2, 2, 3, 3])
+        self.assertEqual(len(failed), 4)
+
+    def test_estimate_cost_uses_model_defaults(self):
+        job = {'model': _Model, 'params': {}, 'data': _Data('a')}
+        self.assertEqual(scheduler.estimate_cost(job), 10 * 2 * 3 * 10)
+        job['params'] = {'depth': 1, 'fit_c': 'random'}
+        self.assertEqual(scheduler.estimate_cost(job), 10 * 2 * 1 * 10 * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
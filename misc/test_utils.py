@@ -0,0 +1,144 @@
+"""
+Regression checks of utils.py, run by python -m unittest discover -s misc (or pytest). Needs config.py (see
+config.py.local), cache directory is replaced by a temporary one
+"""
+
+import os, sys
+import shutil, tempfile
+import unittest
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import utils
+from config import c
+
+
+calls = []
+
+
+@utils.cached_FS_list_np
+def _arrays(n=5, kind="plain"):
+    calls.append(kind)
+    if kind == "plain":
+        return [np.arange(n, dtype=np.float64), np.ones((n, 2))]
+    elif kind == "object":
+        return np.array([np.arange(i + 1) for i in xrange(n)] + [None], dtype=object)
+    else:
+        return (sparse.csr_matrix(np.eye(n)), np.arange(n), {"n": n})
+
+
+@utils.cached_FS()
+def _pickled(k=1, fail=False):
+    calls.append(k)
+    if fail:
+        raise RuntimeError("computed")
+    return np.arange(1000.) * k
+
+
+def _raise_load(key):
+    raise RuntimeError("broken load_fnc")
+
+
+@utils.cached_FS(load_fnc=_raise_load)
+def _unloadable(k=1):
+    return k
+
+
+class _CacheDirTest(unittest.TestCase):
+
+    def setUp(self):
+        self._config = dict(c)
+        c["CACHE_DIR"] = tempfile.mkdtemp()
+        del calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(c["CACHE_DIR"])
+        c.clear()
+        c.update(self._config)
+
+
+class TestNumpyBackend(_CacheDirTest):
+
+    def test_plain_arrays_are_memory_mapped(self):
+        first, second = _arrays(n=5, kind="plain"), _arrays(n=5, kind="plain")
+        self.assertEqual(calls, ["plain"])
+        self.assertTrue(all(isinstance(ar, np.memmap) for ar in second))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(first, second)))
+
+    def test_object_and_sparse_values_are_cached(self):
+        obj, other = _arrays(n=5, kind="object"), _arrays(n=5, kind="object")
+        self.assertEqual(calls, ["object"])
+        self.assertEqual(len(obj), len(other))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(obj[:-1], other[:-1])))
+
+        first, second = _arrays(n=4, kind="sparse"), _arrays(n=4, kind="sparse")
+        self.assertEqual(calls, ["object", "sparse"])
+        self.assertTrue(isinstance(second, tuple))
+        self.assertTrue(sparse.issparse(second[0]))
+        self.assertEqual((first[0] != second[0]).nnz, 0)
+        self.assertTrue(np.array_equal(first[1], second[1]))
+        self.assertEqual(first[2], second[2])
+
+
+class TestCachedFS(_CacheDirTest):
+
+    def _keys(self):
+        return sorted(utils._load_cache_index())
+
+    def test_cache_size_cap(self):
+        c["CACHE_MAX_SIZE"] = 20000  # two entries of ~8kB
+        _pickled(k=1), _pickled(k=2)
+        keys = self._keys()
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(len(os.listdir(os.path.join(c["CACHE_DIR"], "locks"))), 2)
+
+        _pickled(k=1)  # k=2 is least recently used
+        _pickled(k=3)
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual(len(self._keys()), 2)
+        evicted = [k for k in keys if k not in self._keys()]
+        self.assertEqual(len(evicted), 1)
+        self.assertFalse(os.path.exists(os.path.join(c["CACHE_DIR"], evicted[0] + ".cache.pkl")))
+        self.assertFalse(os.path.exists(os.path.join(c["CACHE_DIR"], "locks", evicted[0] + ".lock")))
+
+        _pickled(k=1), _pickled(k=2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_partial_entry_is_recomputed(self):
+        _pickled(k=1)
+        key = self._keys()[0]
+        path = os.path.join(c["CACHE_DIR"], key + ".cache.pkl")
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[:len(data) // 2])
+        self.assertTrue(np.array_equal(_pickled(k=1), np.arange(1000.)))
+        self.assertEqual(calls, [1, 1])
+
+    def test_load_errors_are_raised(self):
+        _unloadable(k=1)
+        self.assertRaises(RuntimeError, _unloadable, k=1)
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_size_cap(self):
+        for policy in ["lru", "lfu"]:
+            cache = utils.MemoryCache(max_bytes=20000, policy=policy)
+            cache.put("a", np.zeros(1000))
+            cache.put("b", np.zeros(1000))
+            for _ in xrange(3):
+                self.assertEqual(cache.get("a").shape, (1000,))
+            cache.put("c", np.zeros(1000))
+            self.assertEqual(sorted(k for k in ["a", "b", "c"] if k in cache), ["a", "c"])
+            self.assertTrue(cache.stats()["nbytes"] <= 20000)
+
+            # Value bigger than the whole budget is not kept
+            cache.put("d", np.zeros(5000))
+            self.assertFalse("d" in cache)
+            self.assertTrue("a" in cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
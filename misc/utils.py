@@ -14,14 +14,15 @@ import mmap
 import pandas as pd
 from scipy import sparse
 import matplotlib
+import threading
+import hashlib
+import json
+import sys
+from collections import OrderedDict
 
 matplotlib.use('Qt4Agg')
 
 
-# This will be used when used cache_ram=True
-mem_storage = {}
-
-
 def timed(func):
     """ Decorator for easy time measurement """
 
@@ -36,21 +37,114 @@ def timed(func):
     return timed
 
 
-cache_dict = {}
+def _nbytes(value, depth=0):
+    """
+    Approximate memory held by value: arrays by nbytes (also inside sparse matrices, pandas objects, containers and
+    object attributes, e.g. datasets), anything else by sys.getsizeof
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        return sum(_nbytes(getattr(value, name)) for name in ["data", "indices", "indptr", "row", "col"]
+                   if hasattr(value, name))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.values.nbytes
+    if depth > 5:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_nbytes(k, depth + 1) + _nbytes(v, depth + 1) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(_nbytes(v, depth + 1) for v in value)
+    if hasattr(value, "__dict__") and not hasattr(value, "__call__"):
+        return sys.getsizeof(value) + _nbytes(vars(value), depth + 1)
+    return sys.getsizeof(value)
+
+
+_MISSING = object()
+
+
+class MemoryCache(object):
+    """
+    Thread safe in-memory cache with byte budget (see _nbytes). When it is exceeded least recently used ('lru') or
+    least frequently used ('lfu', ties broken by recency) entries are evicted. Values larger than the whole budget
+    are not stored. hits, misses and evictions count lookups since creation (or clear).
+    """
+
+    def __init__(self, max_bytes=None, policy="lru"):
+        """
+        @param max_bytes budget in bytes, None for no limit
+        """
+        if policy not in ["lru", "lfu"]:
+            raise ValueError("Unknown eviction policy " + str(policy))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()  # key -> (value, nbytes, uses), least recently used first
+            self.nbytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, nbytes, uses = self._entries.pop(key)
+            self._entries[key] = (value, nbytes, uses + 1)
+            return value
+
+    def put(self, key, value):
+        nbytes = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                return
+            self._entries[key] = (value, nbytes, 1)
+            self.nbytes += nbytes
+
+            while self.max_bytes is not None and self.nbytes > self.max_bytes:
+                # The new entry is the most recent one and is never evicted by its own insertion
+                if self.policy == "lru":
+                    victim = next(iter(self._entries))
+                else:
+                    victim = min((k for k in self._entries if k != key), key=lambda k: self._entries[k][2])
+                self.nbytes -= self._entries.pop(victim)[1]
+                self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self),
+                "nbytes": self.nbytes, "max_bytes": self.max_bytes}
 
 
-def cached_in_memory(func):
-    global cache_dict
+# Memory tier of cached_in_memory and cached_FS(cache_ram=True), budget c["MEMORY_CACHE_MAX_SIZE"] (bytes)
+mem_storage = MemoryCache(max_bytes=c.get("MEMORY_CACHE_MAX_SIZE", None))
 
+
+def cached_in_memory(func):
+    """
+    Caches results in mem_storage, keyed by function name and digest of arguments (arrays by contents)
+    """
     def func_caching(*args, **dict_args):
+        digest = hashlib.sha1()
+        _hash_value(digest, [list(args), dict_args])
+        key = func.__name__ + "_" + digest.hexdigest()
 
-        key = (func.__name__, args, frozenset(dict_args.items()))
-        if key in cache_dict:
-            return cache_dict[key]
-        else:
+        returned_value = mem_storage.get(key, _MISSING)
+        if returned_value is _MISSING:
             returned_value = func(*args, **dict_args)
-            cache_dict[key] = returned_value
-            return returned_value
+            mem_storage.put(key, returned_value)
+        return returned_value
 
     return func_caching
 
@@ -71,10 +165,14 @@ def scikit_check(key):
 
 
 def scikit_save(key, val):
+    # joblib writes several files, they are dumped into temporary directory which is then renamed
     dir = os.path.join(c["CACHE_DIR"], key)
-    os.system("mkdir " + dir)
-    file_name = os.path.join(dir, key + ".pkl")
-    joblib.dump(val, file_name)
+    tmp_dir = os.path.join(c["CACHE_DIR"], "." + key + ".tmp" + str(os.getpid()))
+    os.makedirs(tmp_dir)
+    joblib.dump(val, os.path.join(tmp_dir, key + ".pkl"))
+    if os.path.isdir(dir):
+        shutil.rmtree(dir)
+    os.rename(tmp_dir, dir)
 
 
 def scipy_csr_load(key):
@@ -88,13 +186,13 @@ def scipy_csr_check(key):
 
 
 def scipy_csr_save(key, val):
-    file_name = os.path.join(c["CACHE_DIR"], key)
-    np.savez(file_name, val.data, val.indices, val.indptr, val.shape)
+    file_name = os.path.join(c["CACHE_DIR"], key + ".npz")
+    _atomic_write(file_name, lambda f: np.savez(f, val.data, val.indices, val.indptr, val.shape))
 
 
 def pandas_save_fnc(key, val):
     file_name = os.path.join(c["CACHE_DIR"] + key + ".msg")
-    val.to_msgpack(file_name)
+    _atomic_write(file_name, lambda f: val.to_msgpack(f))
 
 
 def pandas_check_fnc(key):
@@ -106,31 +204,72 @@ def pandas_load_fnc(key):
     return pd.read_msgpack(file_name)
 
 
+def _np_storable(val):
+    # Arrays which can be saved as raw .npy and memory-mapped (not object dtype, not sparse)
+    if sparse.issparse(val):
+        return None
+    val = np.asanyarray(val)
+    return None if val.dtype.hasobject else val
+
+
+def _save_np_or_pickle(path, val):
+    # Writes path.npy, or path.pkl when val cannot be memory-mapped
+    ar = _np_storable(val)
+    if ar is not None:
+        _atomic_write(path + ".npy", lambda f: np.save(f, ar))
+    else:
+        _atomic_write(path + ".pkl", lambda f: cPickle.dump(val, f, cPickle.HIGHEST_PROTOCOL))
+
+
+def _load_np_or_pickle(path, mmap_mode):
+    if os.path.exists(path + ".pkl"):
+        with open(path + ".pkl", "rb") as f:
+            return cPickle.load(f)
+    try:
+        return np.load(path + ".npy", mmap_mode=mmap_mode)
+    except ValueError:
+        # Object array written by older version, cannot be memory-mapped
+        if mmap_mode is None:
+            raise
+        return np.load(path + ".npy")
+
+
 def numpy_save_fnc(key, val):
-    if isinstance(val, tuple):
-        raise "Please use list to make numpy_save_fnc work"
-    # Note - not using savez because it is reportedly slow.
-    if isinstance(val, list):
-        logger.info("Saving as list")
-        save_path = os.path.join(c["CACHE_DIR"], key)
-        save_dict = {}
+    """
+    Saves array as key.npy, list or tuple of arrays as key.0.npy, key.1.npy, .. and marker key.list written last
+    (entry exists only when complete). Raw .npy files are memory-mapped by numpy_load_fnc. Values which cannot be
+    memory-mapped (sparse matrices, object arrays) are pickled into .pkl instead of .npy.
+    """
+    if isinstance(val, (list, tuple)):
+        logger.info("Saving as " + type(val).__name__)
         for id, ar in enumerate(val):
-            save_dict[str(id)] = ar
-        np.savez(save_path, **save_dict)
+            _save_np_or_pickle(os.path.join(c["CACHE_DIR"], key + "." + str(id)), ar)
+        _atomic_write(os.path.join(c["CACHE_DIR"], key + ".list"),
+                      lambda f: json.dump({"type": type(val).__name__, "len": len(val)}, f))
     else:
         logger.info("Saving as array " + str(val.shape))
-        np.save(os.path.join(c["CACHE_DIR"], key + ".npy"), val)
+        _save_np_or_pickle(os.path.join(c["CACHE_DIR"], key), val)
 
 
 def numpy_check_fnc(key):
-    return len(glob.glob(os.path.join(c["CACHE_DIR"], key + ".np*"))) > 0
+    return any(os.path.exists(os.path.join(c["CACHE_DIR"], key + ext)) for ext in [".npy", ".pkl", ".list", ".npz"])
 
 
-def numpy_load_fnc(key):
-    if os.path.exists(os.path.join(c["CACHE_DIR"], key + ".npz")):
+def numpy_load_fnc(key, mmap_mode="r"):
+    """
+    Returns arrays memory-mapped read-only (mmap_mode as in np.load), so that all processes share one page cache copy
+    and nothing is read until used. Pickled values and lists saved as .npz by older versions are read eagerly.
+    """
+    prefix = os.path.join(c["CACHE_DIR"], key)
+    if os.path.exists(prefix + ".list"):
+        with open(prefix + ".list") as f:
+            meta = json.load(f)
+        ar = [_load_np_or_pickle(prefix + "." + str(id), mmap_mode) for id in xrange(meta["len"])]
+        return tuple(ar) if meta["type"] == "tuple" else ar
+    elif os.path.exists(prefix + ".npz"):
         # Listed numpy array
 
-        savez_file = np.load(os.path.join(c["CACHE_DIR"], key + ".npz"))
+        savez_file = np.load(prefix + ".npz")
 
         ar = []
 
@@ -139,48 +278,195 @@ def numpy_load_fnc(key):
             ar.append(savez_file[str(k)])
         return ar
     else:
-        return np.load(os.path.join(c["CACHE_DIR"], key + ".npy"))
+        return _load_np_or_pickle(prefix, mmap_mode)
 
 
-import hashlib
-import sys
+import errno
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+# Single index of cached_FS entries (key -> call and size in bytes), rewritten only when an entry is written
+CACHE_INDEX = "cache_index.json"
+
+
+def _hash_value(digest, v):
+    """
+    Feeds canonical form of v into digest: arrays (also sparse and pandas) by dtype, shape and contents, containers
+    element-wise (dicts in sorted order), functions by module and name, other objects by type and public attributes
+    """
+    def update(tag, s):
+        digest.update(tag + ":" + str(len(s)) + ":")
+        digest.update(s)
+
+    if isinstance(v, np.ndarray):
+        update("ndarray", str(v.dtype) + str(v.shape))
+        if v.dtype == object:
+            _hash_value(digest, v.tolist())
+        else:
+            digest.update(np.ascontiguousarray(v).view(np.uint8))
+    elif sparse.issparse(v):
+        v = v.tocsr()
+        update("csr", str(v.shape))
+        for array in [v.data, v.indices, v.indptr]:
+            _hash_value(digest, array)
+    elif isinstance(v, (pd.DataFrame, pd.Series)):
+        update(type(v).__name__, "")
+        _hash_value(digest, [list(v.index), list(getattr(v, "columns", [])), v.values])
+    elif isinstance(v, dict):
+        update("dict", str(len(v)))
+        for k in sorted(v):
+            _hash_value(digest, k)
+            _hash_value(digest, v[k])
+    elif isinstance(v, (list, tuple, set, frozenset)):
+        update(type(v).__name__, str(len(v)))
+        for x in (sorted(v) if isinstance(v, (set, frozenset)) else v):
+            _hash_value(digest, x)
+    elif isinstance(v, (basestring, int, long, float, bool, type(None))):
+        update(type(v).__name__, repr(v))
+    elif hasattr(v, "func") and hasattr(v, "keywords"):
+        # functools.partial
+        update("partial", "")
+        _hash_value(digest, [v.func, v.args, v.keywords or {}])
+    elif hasattr(v, "__call__") and hasattr(v, "__name__"):
+        update("fnc", str(getattr(v, "__module__", "")) + "." + v.__name__)
+    elif hasattr(v, "__dict__"):
+        # Private attributes are caches and handles (e.g. MappedDataset arrays)
+        update("object", type(v).__name__)
+        _hash_value(digest, dict((k, x) for k, x in vars(v).iteritems() if not k.startswith("_")))
+    else:
+        update("repr", repr(v))
 
 
 def generate_key(func_name, args, dict_args_original, skip_args):
-    args_concat = [v for key, v in sorted(dict_args_original.iteritems()) if key not in skip_args]
+    """
+    @returns key (function name and digest of canonicalized arguments), description of the call for the index
+    """
+    dict_args = dict((k, v) for k, v in dict_args_original.iteritems() if k not in skip_args)
 
+    digest = hashlib.sha1()
+    _hash_value(digest, [list(args), dict_args])
+    key = func_name + "_" + digest.hexdigest()
 
+    def describe(v):
+        s = v.__name__ if hasattr(v, "__call__") and hasattr(v, "__name__") else str(v)
+        return s if len(s) < 200 else type(v).__name__ + "#" + hashlib.md5(s).hexdigest()
 
+    full_key = func_name + "(" + ", ".join(str(k) + "=" + describe(v) for k, v in sorted(dict_args.iteritems())) + ")"
 
-    # Get serialized arguments (function name, or string of v if is not reference checked in ugly way
-    args_serialized = \
-        '_'.join([
-            v.__name__
-            if hasattr(v, '__call__')
-            else
-            (str(v) if len(str(v)) < 200 else hashlib.md5(str(v)).hexdigest())
-            for v in args_concat if hasattr(v, '__call__') or hasattr(v, "__init__") or str(v).find("0x") == -1])
+    return key, full_key
 
-    logger.info("Serialized args to " + args_serialized)
 
-    key = func_name + "_" + args_serialized
+@contextmanager
+def _file_lock(path):
+    # Exclusive lock shared by all processes (and threads, every call opens its own file)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
-    full_key = func_name + "(" + "".join(
-        [str(k) + "=" + (str(v) if len(str(v)) < 200 else hashlib.md5(str(v)).hexdigest())
-         for k, v in sorted(dict_args_original.iteritems()) if key not in skip_args])
 
-    if len(key) > 400:
-        key = key[0:400]
+def _atomic_write(path, write):
+    """
+    Calls write(file) on temporary file next to path and renames it to path, so readers never see partial files.
+    Temporary name starts with a dot and does not match key globs of check functions.
+    """
+    tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp" + str(os.getpid()))
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _entry_files(key):
+    # Files (or directory of scikit_save) of cache entry written by any of the save functions
+    prefix = os.path.join(c["CACHE_DIR"], key)
+    return glob.glob(prefix + ".*") + ([prefix] if os.path.isdir(prefix) else [])
+
+
+def _entry_size(files):
+    size = 0
+    for path in files:
+        if os.path.isdir(path):
+            size += sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(path) for f in fs)
+        else:
+            size += os.path.getsize(path)
+    return size
 
-    return key, full_key
+
+def _touch_entry(key):
+    # Modification time of entry files is its last use for LRU eviction (index is not rewritten on hits)
+    for path in _entry_files(key):
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+
+def _load_cache_index():
+    path = os.path.join(c["CACHE_DIR"], CACHE_INDEX)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _lock_path(key):
+    return os.path.join(c["CACHE_DIR"], "locks", key + ".lock")
+
+
+def _register_entry(key, full_key):
+    """
+    Adds written entry to the index and evicts least recently used entries (with their lock files) until the cache
+    fits into c["CACHE_MAX_SIZE"] bytes
+    """
+    max_size = c.get("CACHE_MAX_SIZE", None)
+    with _file_lock(os.path.join(c["CACHE_DIR"], CACHE_INDEX + ".lock")):
+        index = _load_cache_index()
+        index[key] = {"call": full_key, "size": _entry_size(_entry_files(key))}
+
+        total = sum(entry["size"] for entry in index.itervalues())
+        if max_size is not None and total > max_size:
+            def last_used(k):
+                return max([os.path.getmtime(path) for path in _entry_files(k)] or [0])
+
+            for k in sorted([k for k in index if k != key], key=last_used):
+                if total <= max_size:
+                    break
+                logger.info("Evicting " + k + " from cache")
+                for path in _entry_files(k):
+                    if os.path.isdir(path):
+                        shutil.rmtree(path, ignore_errors=True)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                if os.path.exists(_lock_path(k)):
+                    os.remove(_lock_path(k))
+                total -= index.pop(k)["size"]
+
+        _atomic_write(os.path.join(c["CACHE_DIR"], CACHE_INDEX), lambda f: json.dump(index, f, indent=0))
 
 
 def cached_FS(save_fnc=None, load_fnc=None, check_fnc=None, skip_args=None, cache_ram=False, use_cPickle=False):
     """
     To make it work correctly please pass parameters to function as dict
 
+    Key is function name with digest of canonicalized arguments (arrays by contents). Value is computed and written
+    under per key file lock (concurrent workers wait for the first one instead of computing it again) and atomically
+    renamed into place. Written entries are recorded in CACHE_DIR/cache_index.json.
+
     @param save_fnc, load_fnc function(key, returned_value)
     @param check_fnc function(key) returning True/False
+
+    Size of the whole cache directory is capped by c["CACHE_MAX_SIZE"] bytes (if set), least recently used entries
+    are evicted after writes.
+
+    Passing use_mmap=True to the cached function maps pickle file, but unpickling still copies it. Arrays are loaded
+    without copying by the numpy backend (cached_FS_list_np), which memory-maps them.
     """
     if not skip_args:
         skip_args = {}
@@ -201,61 +487,79 @@ def cached_FS(save_fnc=None, load_fnc=None, check_fnc=None, skip_args=None, cach
 
             key, fullkey = generate_key(func.__name__, args, dict_args_original, skip_args)
 
-            # For retrievel
-            if not os.path.exists(os.path.join(c["CACHE_DIR"], "cache_dict.txt")):
-                with open(os.path.join(c["CACHE_DIR"], "cache_dict.txt"), "w") as f:
-                    f.write("File containing hashes explanation for refernce\n ==== \n")
-
-            with open(os.path.join(c["CACHE_DIR"], "cache_dict.txt"), "a") as f:
-                f.write(key + "\n" + fullkey + "\n")
-
-            if cache_ram and key in mem_storage:
-                print("Reading from cache ram")
-                return mem_storage[key]
+            if cache_ram:
+                value = mem_storage.get(key, _MISSING)
+                if value is not _MISSING:
+                    print("Reading from cache ram")
+                    return value
 
             logger.info("Checking key " + key)
             cache_file_default = os.path.join(c["CACHE_DIR"], str(key) + ".cache.pkl")
-            exists = os.path.exists(cache_file_default) if check_fnc is None else check_fnc(key)
+            pickler = cPickle if use_cPickle else pickle
 
-            def evaluate_and_write():
-                logger.info("Cache miss or force reload. Caching " + key)
-                returned_value = func(*args, **dict_args_original)
-                if save_fnc:
-                    save_fnc(key, returned_value)
-                else:
-                    with open(cache_file_default, "w") as f:
-                        if use_cPickle:
-                            cPickle.dump(returned_value, f)
-                        else:
-                            pickle.dump(returned_value, f)
+            def load():
+                """
+                @returns True, cached value or False, None when there is no (readable) entry
+                """
+                exists = os.path.exists(cache_file_default) if check_fnc is None else check_fnc(key)
+                if not exists:
+                    return False, None
 
-                if cache_ram:
-                    mem_storage[key] = returned_value
-
-                return returned_value
-
-            if exists and not "force_reload" in dict_args:
                 logger.info("Loading (pickled?) file")
-
-                if load_fnc:
-                    return load_fnc(key)
-                else:
-                    # We do try here because we might have failed writing pickle file before
-                    try:
-                        with open(cache_file_default, "r") as f:
+                # Entry might have been evicted meanwhile (missing files) or partially written by older version,
+                # both are a miss. Any other error is raised
+                try:
+                    if load_fnc:
+                        value = load_fnc(key)
+                    else:
+                        with open(cache_file_default, "rb") as f:
                             if "use_mmap" in dict_args:
                                 g = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
-                                obj = cPickle.load(g) if use_cPickle  else pickle.load(g)
+                                value = pickler.load(g)
                                 g.close()
-                                return obj
                             else:
-                                obj = cPickle.load(f) if use_cPickle else pickle.load(f)
-                                return obj
-                    except:
-                       return evaluate_and_write()
+                                value = pickler.load(f)
+                except (IOError, OSError) as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    logger.info("Entry " + key + " evicted while loading")
+                    return False, None
+                except (EOFError, pickle.UnpicklingError, cPickle.UnpicklingError) as e:
+                    logger.warning("Partial entry " + key + " (" + str(e) + "), recomputing")
+                    return False, None
+
+                _touch_entry(key)
+                return True, value
+
+            force_reload = "force_reload" in dict_args
+            found, value = (False, None) if force_reload else load()
+
+            if not found:
+                lock_dir = os.path.dirname(_lock_path(key))
+                if not os.path.isdir(lock_dir):
+                    try:
+                        os.makedirs(lock_dir)
+                    except OSError:
+                        pass  # Created by other worker
+
+                with _file_lock(_lock_path(key)):
+                    # Other worker could have written it while we waited
+                    found, value = (False, None) if force_reload else load()
+
+                    if not found:
+                        logger.info("Cache miss or force reload. Caching " + key)
+                        value = func(*args, **dict_args_original)
+                        if save_fnc:
+                            save_fnc(key, value)
+                        else:
+                            _atomic_write(cache_file_default,
+                                          lambda f: pickler.dump(value, f, pickle.HIGHEST_PROTOCOL))
+                        _register_entry(key, fullkey)
+
+            if cache_ram:
+                mem_storage.put(key, value)
 
-            else:
-               return evaluate_and_write()
+            return value
 
         return func_caching
 
@@ -9,58 +9,218 @@ from sklearn.cross_validation import KFold, cross_val_score
 from sklearn.linear_model import LogisticRegression
 
 from functools import partial
+import copy
+import os
+import json
+import cPickle
+import hashlib
+import tempfile
+import time
+import struct
+import zipfile
+import resource
+from contextlib import contextmanager
 from elm import ELM
+import activations
 
 from sklearn.base import BaseEstimator, clone
+from sklearn.utils import check_random_state
+from sklearn.externals.joblib import Parallel, delayed
 
 
 class MyLinModel(BaseEstimator):
-    def __init__(self,w,b):
+    def __init__(self, w, b, classes=None, threshold=0.):
+        """
+        @param classes labels returned by predict (indices when None)
+        @param threshold decision threshold when w has single row (binary problem)
+        """
         assert isinstance(b, (int, long, float)) or len(b.shape) == 1
         self.w=w
         self.b=b
+        self.classes=classes
+        self.threshold=threshold
 
     def fit(self, X, Y):
         pass
 
     def predict(self, X):
-        return np.argmax(self.decision_function(X), axis=1)
+        d = self.decision_function(X)
+        if d.ndim == 2 and d.shape[1] > 1:
+            ids = np.argmax(d, axis=1)
+        else:
+            ids = (d.ravel() > self.threshold).astype(int)
+        return ids if self.classes is None else np.asarray(self.classes)[ids]
 
     def decision_function(self, X):
         return X.dot(self.w.T) + self.b
 
-def make_rand_vector(dims):
-    vec = [np.random.normal(0, 1) for i in range(dims)]
-    mag = sum(x**2 for x in vec) ** .5
-    return np.array([[x/mag for x in vec]])
+def make_rand_vectors(n, dims, random_state=None):
+    """
+    @returns n random directions (unit rows, shape (n, dims)) drawn in a single call
+    """
+    random_state = check_random_state(random_state)
+    vec = random_state.normal(size=(n, dims))
+    vec /= np.sqrt(np.einsum('ij,ij->i', vec, vec)).reshape(-1, 1)
+    return vec
+
+
+def make_rand_vector(dims, random_state=None):
+    return make_rand_vectors(1, dims, random_state)
+
+
+def _fit_candidate(model, X, Y, X_score, Y_score):
+    model.fit(X, Y)
+    return model, sklearn.metrics.accuracy_score(model.predict(X_score), Y_score)
+
+
+def _linear_layer(model):
+    """
+    @returns MyLinModel predicting the same as fitted layer model (linear models and ELM with linear activation)
+    """
+    if isinstance(model, MyLinModel):
+        return model
+    elif hasattr(model, 'coef_') and hasattr(model, 'intercept_'):
+        return MyLinModel(model.coef_, np.ravel(model.intercept_), classes=model.classes_)
+    elif isinstance(model, ELM) and model.activation == 'linear' and hasattr(model, 'beta'):
+        # X W beta, binary targets are {0, 1} so LabelBinarizer thresholds at their middle
+        w = model.W.dot(model.beta).T
+        threshold = (model.lb.pos_label + model.lb.neg_label) / 2.
+        return MyLinModel(w, np.zeros(w.shape[0], dtype=w.dtype), classes=model.lb.classes_, threshold=threshold)
+    raise ValueError("Can not write " + type(model).__name__ + " as linear model")
+
+
+def _cpu_time():
+    # User and system time of this process (all threads)
+    t = os.times()
+    return t[0] + t[1]
+
+
+@contextmanager
+def _phase(profile, name):
+    """
+    Adds wall and CPU time of the block to profile[name], yields dict where the block can put 'nbytes' of arrays it
+    allocated. Does nothing when profile is None.
+    """
+    entry = {}
+    if profile is None:
+        yield entry
+        return
+    wall, cpu = time.time(), _cpu_time()
+    yield entry
+    total = profile.setdefault(name, {'wall': 0., 'cpu': 0., 'nbytes': 0})
+    total['wall'] += time.time() - wall
+    total['cpu'] += _cpu_time() - cpu
+    total['nbytes'] += entry.get('nbytes', 0)
+
+
+# Params of R2Learner which do not influence fitting of a layer model given its input and random state (layer cache
+# key gets them through the transformation of the input, see R2Learner._next_layer_key)
+_LAYER_KEY_SKIP = ['depth', 'seed', 'beta', 'use_prev', 'activation', 'recurrent', 'scale', 'profile', 'layer_cache']
+
+
+def _array_digest(a):
+    a = np.asarray(a)
+    if a.dtype.hasobject:
+        return hashlib.sha1(repr(a.tolist())).hexdigest()
+    digest = hashlib.sha1(str(a.dtype) + str(a.shape))
+    digest.update(np.ascontiguousarray(a).view(np.uint8))
+    return digest.hexdigest()
+
+
+def _cache_repr(v):
+    """
+    Canonical string of v for layer cache keys: arrays by digest of contents, estimators by params, classes and
+    functions by name. Objects which can be told apart only by address raise ValueError.
+    """
+    if isinstance(v, partial):
+        return _cache_repr(v.func) + _cache_repr([list(v.args), v.keywords or {}])
+    elif isinstance(v, dict):
+        return "{" + ", ".join(_cache_repr(k) + ": " + _cache_repr(v[k]) for k in sorted(v)) + "}"
+    elif isinstance(v, (list, tuple)):
+        return "[" + ", ".join(_cache_repr(x) for x in v) + "]"
+    elif isinstance(v, np.ndarray):
+        return "array(" + _array_digest(v) + ")"
+    elif isinstance(v, np.random.RandomState):
+        return "RandomState(" + _cache_repr(list(v.get_state())) + ")"
+    elif isinstance(v, type) or (callable(v) and hasattr(v, '__name__')):
+        return str(getattr(v, '__module__', '')) + "." + v.__name__
+    elif hasattr(v, 'get_params'):
+        return type(v).__name__ + _cache_repr(v.get_params(deep=False))
+    elif " at 0x" in repr(v):
+        raise ValueError("Can not build layer cache key from " + repr(v))
+    return repr(v)
+
+
+def _load_layer_entry(directory, key):
+    # None if layer is not cached (or its entry is not readable)
+    try:
+        with open(os.path.join(directory, key + '.layer.pkl'), 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+
+def _save_layer_entry(directory, key, entry):
+    # Written to temporary file and renamed, concurrent fits of the same layer can only replace it by equal entry
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # Created by other process
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + key)
+    with os.fdopen(fd, 'wb') as f:
+        cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, os.path.join(directory, key + '.layer.pkl'))
 
 
 def _r2_compress_model(r2):
     """
-    If models are LinearMixins <=> have coefs_ and coef0_ it rewrites to dicts (nope, idk why)//those to MyLinModel. It is still functional model :)
+    Drops training state of fitted R2 model and rewrites its layer models to MyLinModel. It is still functional
+    model :) Layers which are not linear are kept as they are.
     """
-    # #
-    #MyLinModel(r2.models_[id].coef_, r2.models_[id].intercept_)
     r2._X_tr = []
     r2._X_moved = []
     r2.X_tr = []
+    r2._o = []
+    r2._delta = []
     for id, m in enumerate(r2.models_):
-        # I know it should be class testing ok?
-        if hasattr(r2.models_[id], 'coef_'):
-            if hasattr(r2.models_[id], 'intercept_'):
-                r2.models_[id] = {"w": r2.models_[id].coef_, "b":  r2.models_[id].intercept_, "params": r2.models_[id].get_params()}
-            elif hasattr(r2.models_[id], 'coef0'):
-                r2.models_[id] = {"w": r2.models_[id].coef_, "b":  r2.models_[id].coef0, "params": r2.models_[id].get_params()}
+        try:
+            r2.models_[id] = _linear_layer(m)
+        except ValueError:
+            pass
     return r2
 
 class R2Learner(BaseEstimator):
     def __init__(self, C=1, activation='sigmoid', recurrent=True, depth=7, \
                  seed=None, beta=0.1, scale=False, use_prev=False, fit_c=None, base_cls=None,
-				fixed_prediction=False, is_base_multiclass=False, switched=False):
+				fixed_prediction=False, is_base_multiclass=False, switched=False, dtype=np.float64, fit_c_holdout=None,
+                 n_jobs=1, profile=False, layer_cache=None):
+        """
+        @param layer_cache directory of layer cache shared by processes, None disables it. Fitted layer model and its
+            output are stored under a key chained from the training data, fit params, params of the transformations
+            producing layer's input and state of the random generator, so models with common layer prefix (e.g. grid
+            points differing only in beta or use_prev share first layer) fit it once and resume from the deepest
+            cached layer. Transformations are recomputed, results are identical to fits without cache.
+        @param profile record per layer wall time, CPU time and allocated bytes of fit and predict phases
+            (fit_layer, layer_output, projection, activation, scaling, predict) and max RSS of the process after the
+            layer (KB on Linux) in profile_ = {'fit': [layer dicts], 'predict': [layer dicts of last predict call]}
+        @param n_jobs number of C candidates of fit_c='random' fitted concurrently (-1 for all cores) in processes with
+            memory-mapped input (liblinear seeds through process global rand(), so threads would not be reproducible).
+            Candidates are then independent (no warm start). ELM layers choose C from one decomposition and ignore it.
+        @param fit_c_holdout fraction of layer's data held out to score C candidates of fit_c='random' (winner is
+            then refit on all of it), None scores on training data
+        @param dtype float type of data, projections and activations (np.float32 halves memory and bandwidth),
+            note that liblinear based base models (LinearSVC, LogisticRegression) convert their input to float64
+        """
         self.name = 'r2svm'
+        self.dtype = dtype
         self.fixed_prediction = fixed_prediction
         self.use_prev = use_prev
         self.fit_c = fit_c
+        self.fit_c_holdout = fit_c_holdout
+        self.n_jobs = n_jobs
+        self.profile = profile
+        self.layer_cache = layer_cache
         self.depth = depth
         self.beta = beta
         self.base_cls = base_cls
@@ -80,6 +240,7 @@ class R2Learner(BaseEstimator):
         self._X_moved = []
         self._X_tr = []
         self._prev_C = None
+        self._prev_Cs = []
         self.switched = switched
 
 
@@ -88,118 +249,220 @@ class R2Learner(BaseEstimator):
         # Assumes scaled data passed to it (so you have to scale data)
 
         if i == 0:
-            self._o = []
-            self._delta = np.zeros(shape=X.shape)
+            self._o = np.empty(shape=(X.shape[0], self.K * (self.depth - 1)), dtype=self.dtype, order='F')
+            self._delta = np.zeros(shape=X.shape, dtype=self.dtype)
             self._X_tr = [X]
             self._X_moved = [X]
 
-        if not self._fitted:
-            if self.fit_c is None:
-                self.models_[i].fit(X, Y)
-            elif self.fit_c == 'random_cls' or self.fit_c == 'random_cls_centered':
-                if i != self.depth - 1:
-                    if self.K <= 2:
-                        w = make_rand_vector(X.shape[1])
-                        if self.fit_c == 'random_cls':
-                            b = np.random.uniform(X.min(), X.max())
-                        elif self.fit_c == 'random_cls_centered':
-                            p = w.dot(X.T)
-                            if np.std(p) != 0:
-                                b = np.random.normal((p.max() - p.min())/2, np.std(p))
-                            else:
-                                b = np.random.normal((p.max() - p.min())/2, 1)
-
-                        self.models_[i] = MyLinModel(w, b)
-                    else:
-                        w = np.hstack([make_rand_vector(X.shape[1]).T for _ in range(self.K)]).T
-                        p = w.dot(X.T)
-
-                        if self.fit_c == 'random_cls':
-                            b = np.array([np.random.uniform(X.min(), X.max()) for _ in range(self.K)])
-                        elif self.fit_c == 'random_cls_centered':
-                            b = []
-                            for pi in p:
-                                b.append(np.random.normal((pi.max() - pi.min())/2, np.std(pi)))
-                            b = np.array(b)
-
-                        self.models_[i] = MyLinModel(w, b)
-                else:
-                    self.models_[i].fit(X, Y)
-            elif self.fit_c == 'random' or self.fit_c == 'random_exhaustive':
-                if not self.fixed_prediction or i == self.depth - 1:
-                    best_C = None
-                    best_score = 0.
-                    fit_size = 7 if self.fit_c == 'random_exhaustive' else 4
-                    if type(self.models_[i]) == ELM:
-                        c = [10**j for j in xrange(0, fit_size)]
-                    elif type(self.models_[i]) == LinearSVC or type(self.models_[i] == LogisticRegression) :
-                        c = np.random.uniform(size=fit_size)
-                        c = MinMaxScaler((-7, 7)).fit_transform(c) if self.fit_c == 'random_exhaustive' else MinMaxScaler((-2,8)).fit_transform(c)
-                        c = [np.exp(x) for x in c]
-                        # Add one and previous
-                        c = list(set(c).union([1]).union([self._prev_C])) if self._prev_C else list(set(c).union([1]))
-
-                    for j in xrange(fit_size):
-                        model = clone(self.models_[i]).set_params(estimator__C=c[j]) if not self.is_base_multiclass \
-                                                                                        and self.K > 2 else \
-                            clone(self.models_[i]).set_params(C=c[j])
-                        score = sklearn.metrics.accuracy_score(model.fit(X,Y).predict(X), Y)
-                        #scores = cross_val_score(model, X, Y, scoring='accuracy', \
-                        #                         cv=KFold(X.shape[0], shuffle=True, random_state=self.random_state))
-                        #score = scores.mean()
-                        if score > best_score:
-                            best_score = score
-                            best_C = c[j]
-                    assert best_C is not None
-                    self.models_[i].set_params(estimator__C=best_C) if not self.is_base_multiclass and self.K > 2 \
-                        else self.models_[i].set_params(C=best_C)
-                    self._prev_C = best_C
-                    self.models_[i].fit(X, Y)
+        profile = self._layer_profile('fit', i)
+        fitting, cached = not self._fitted, None
 
-        if i != self.depth - 1:
+        if fitting:
+            self._prev_Cs.append(self._prev_C)
+            if self.layer_cache is not None:
+                with _phase(profile, 'layer_cache'):
+                    key = self._next_layer_key(i)
+                    cached = _load_layer_entry(self.layer_cache, key)
 
-            if not self.fixed_prediction:
-                self._o.append(self.models_[i].decision_function(X) if self.K > 2 else \
-		                           np.vstack([-self.models_[i].decision_function(X).reshape(1, -1),
-		                                      self.models_[i].decision_function(X).reshape(1, -1)]).T)
-            elif isinstance(self.fixed_prediction, (int, long, float, complex)):
-                self._o.append(np.ones(shape=(X.shape[0], self.K)) * self.fixed_prediction)
+            if cached is not None:
+                self.models_[i], self._prev_C = cached['model'], cached['prev_C']
+                self.random_state.set_state(cached['random_state'])
             else:
-                raise NotImplementedError("self.fixed_prediction is wut?")
+                with _phase(profile, 'fit_layer'):
+                    self.models_[i] = self._fit_layer(self.models_[i], X, Y, last=(i == self.depth - 1),
+                                                      prev_model=self.models_[i - 1] if i > 0 else None)
 
-            if self.recurrent:
-                self._delta = sum(np.dot(self._o[j], self.W[i][j]) for j in range(i+1))
-            else:
-                self._delta = np.dot(self._o[i], self.W[i])
+            if self.layer_cache is not None and cached is None:
+                entry = {'model': self.models_[i], 'prev_C': self._prev_C,
+                         'random_state': self.random_state.get_state()}
 
-            if self.use_prev:
-                self._X_moved.append(X + self.beta * self._delta)
-                X = getattr(self, "_" + self.activation)(self._X_moved[-1])
-            else:
-                self._X_moved.append(self._X_tr[0] + self.beta * self._delta)
-                X = getattr(self, "_" + self.activation)(self._X_moved[-1])
+        if i != self.depth - 1:
 
-            if self.scale:
-                if not self._fitted:
-                    X = self.scalers_[i + 1].fit_transform(X)
+            with _phase(profile, 'layer_output') as p:
+                self._o[:, i*self.K:(i+1)*self.K] = self._layer_output(i, X) if cached is None else cached['o']
+                p['nbytes'] = self._o[:, i*self.K:(i+1)*self.K].nbytes
+
+            with _phase(profile, 'projection') as p:
+                if self.recurrent:
+                    # Single product of all previous outputs with concatenated weights
+                    self._delta = np.dot(self._o[:, 0:(i+1)*self.K], self.W_stacked_[i])
+                else:
+                    self._delta = np.dot(self._o[:, i*self.K:(i+1)*self.K], self.W[i])
+                p['nbytes'] = self._delta.nbytes
+
+            with _phase(profile, 'activation') as p:
+                if self.use_prev:
+                    self._X_moved.append(X + self.beta * self._delta)
+                    X = getattr(self, "_" + self.activation)(self._X_moved[-1])
                 else:
-                    X = self.scalers_[i + 1].transform(X)
+                    self._X_moved.append(self._X_tr[0] + self.beta * self._delta)
+                    X = getattr(self, "_" + self.activation)(self._X_moved[-1])
+                p['nbytes'] = self._X_moved[-1].nbytes + X.nbytes
+
+            if self.scale:
+                with _phase(profile, 'scaling') as p:
+                    if not self._fitted:
+                        X = self.scalers_[i + 1].fit_transform(X).astype(self.dtype, copy=False)
+                    else:
+                        X = self.scalers_[i + 1].transform(X).astype(self.dtype, copy=False)
+                    p['nbytes'] = X.nbytes
 
             self._X_tr.append(X)
         else:
             self._fitted = True
 
+        if fitting and self.layer_cache is not None and cached is None:
+            with _phase(profile, 'layer_cache'):
+                if i != self.depth - 1:
+                    entry['o'] = self._o[:, i*self.K:(i+1)*self.K]
+                _save_layer_entry(self.layer_cache, key, entry)
+
+        if profile is not None:
+            profile['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
         return X
 
+    def _next_layer_key(self, i):
+        """
+        Advances layer cache key to i-th layer model: digest of previous key (root is digest of training data), params
+        of the transformation which produced layer's input, fit params and state of the random generator before the fit
+        """
+        parts = [self._layer_key, i, i == self.depth - 1,
+                 dict((k, getattr(self, k, None)) for k in self._get_param_names() if k not in _LAYER_KEY_SKIP),
+                 self.random_state]
+        if i > 0:
+            # use_prev makes no difference for the first transformation (previous input is the original one)
+            parts += [self.activation, self.beta, self.recurrent, self.scale, self.use_prev if i > 1 else None,
+                      self.W_stacked_[i - 1] if self.recurrent else self.W[i - 1]]
+        self._layer_key = hashlib.sha1(_cache_repr(parts)).hexdigest()
+        return self._layer_key
+
+    def _layer_profile(self, stage, i):
+        # Profile dict of i-th layer for stage ('fit' or 'predict'), None when profiling is off
+        return self.profile_[stage][i] if self.profile else None
+
+    def _fit_layer(self, model, X, Y, last=False, prev_model=None):
+        # Fits (or draws when fit_c is random_cls) single layer model and returns it, prev_model is the fitted model
+        # of the previous layer (initial solution of warm started C search)
+        if self.fit_c is None:
+            model.fit(X, Y)
+        elif self.fit_c == 'random_cls' or self.fit_c == 'random_cls_centered':
+            if not last:
+                # One hyperplane for binary problems, one per class otherwise
+                n = 1 if self.K <= 2 else self.K
+                w = make_rand_vectors(n, X.shape[1], self.random_state)
+                if self.fit_c == 'random_cls':
+                    b = self.random_state.uniform(X.min(), X.max(), size=n)
+                elif self.fit_c == 'random_cls_centered':
+                    p = X.dot(w.T)
+                    std = p.std(axis=0)
+                    std[std == 0] = 1
+                    b = self.random_state.normal((p.max(axis=0) - p.min(axis=0))/2, std)
+
+                model = MyLinModel(w, b)
+            else:
+                model.fit(X, Y)
+        elif self.fit_c == 'random' or self.fit_c == 'random_exhaustive':
+            if not self.fixed_prediction or last:
+                fit_size = 7 if self.fit_c == 'random_exhaustive' else 4
+
+                X_fit, Y_fit, X_score, Y_score = X, Y, X, Y
+                if self.fit_c_holdout:
+                    X_fit, Y_fit, X_score, Y_score = self._holdout_split(X, Y)
+
+                if type(model) == ELM:
+                    # Whole C grid from one decomposition of the hidden layer, best solution is kept (no refit)
+                    Cs = [10**j for j in xrange(0, fit_size)]
+                    if self.fit_c_holdout:
+                        model.fit_path(X_fit, Y_fit, Cs, X_score, Y_score, classes=np.unique(Y))
+                        # Held-out part is added to normal equations of the chosen C, hidden layer stays
+                        model.partial_fit(X_score, Y_score)
+                    else:
+                        model.fit_path(X, Y, Cs)
+                    self._prev_C = model.C
+                    return model
+
+                if type(model) == LinearSVC or type(model) == LogisticRegression:
+                    c = self.random_state.uniform(size=fit_size)
+                    c = MinMaxScaler((-7, 7)).fit_transform(c) if self.fit_c == 'random_exhaustive' else MinMaxScaler((-2,8)).fit_transform(c)
+                    c = [np.exp(x) for x in c]
+                    # Add one and previous
+                    c = list(set(c).union([1]).union([self._prev_C])) if self._prev_C else list(set(c).union([1]))
+
+                # Increasing C, so warm started candidates move along the regularization path
+                c = sorted(c[0:fit_size])
+
+                # Sequentially fitted models whose solver honours warm_start (e.g. LogisticRegression with lbfgs, not
+                # liblinear of the shipped learners) reuse one estimator, starting from previous layer's solution
+                # (all layers have inputs of the same dimension)
+                params = model.get_params()
+                warm = self.n_jobs == 1 and 'warm_start' in params and \
+                    params.get('solver', 'liblinear') != 'liblinear'
+                warm_start = params.get('warm_start')
+                candidate = clone(model)
+                if warm:
+                    candidate.set_params(warm_start=True)
+                    if type(prev_model) == type(model) and hasattr(prev_model, 'coef_'):
+                        candidate.coef_ = prev_model.coef_.copy()
+                        candidate.intercept_ = np.copy(prev_model.intercept_)
+
+                best_C, best_model = None, None
+                best_score = -1.
+                if self.n_jobs != 1:
+                    candidates = [self._set_C(clone(model), C) for C in c]
+                    if model.get_params().get('random_state', 0) is None:
+                        # Seeds drawn here in candidate order, so results do not depend on scheduling
+                        for candidate in candidates:
+                            candidate.set_params(random_state=self.random_state.randint(0, np.iinfo(np.int32).max))
+                    fitted = Parallel(n_jobs=self.n_jobs, backend='multiprocessing')(
+                        delayed(_fit_candidate)(candidate, X_fit, Y_fit, X_score, Y_score) for candidate in candidates)
+                    for C, (candidate, score) in zip(c, fitted):
+                        if score > best_score:
+                            best_score, best_C, best_model = score, C, candidate
+                else:
+                    for C in c:
+                        if not warm:
+                            candidate = clone(model)
+                        candidate, score = _fit_candidate(self._set_C(candidate, C), X_fit, Y_fit, X_score, Y_score)
+                        if score > best_score:
+                            best_score = score
+                            best_C = C
+                            best_model = copy.deepcopy(candidate) if warm else candidate
+
+                self._prev_C = best_C
+                model = best_model
+                if self.fit_c_holdout:
+                    model.fit(X, Y)
+                if warm:
+                    model.set_params(warm_start=warm_start)
+
+        return model
+
+    def _set_C(self, model, C):
+        return model.set_params(estimator__C=C) if not self.is_base_multiclass and self.K > 2 else \
+            model.set_params(C=C)
+
+    def _holdout_split(self, X, Y):
+        # Random fit_c_holdout part of every class of the layer's data for scoring C candidates, each class keeps
+        # at least one sample in the fitted part (all data is scored when nothing can be held out)
+        fit_ids, score_ids = [], []
+        for label in np.unique(Y):
+            ids = self.random_state.permutation(np.flatnonzero(Y == label))
+            n_score = min(int(round(self.fit_c_holdout * len(ids))), len(ids) - 1)
+            score_ids.append(ids[0:n_score])
+            fit_ids.append(ids[n_score:])
+        fit_ids, score_ids = np.sort(np.concatenate(fit_ids)), np.sort(np.concatenate(score_ids))
+        if len(score_ids) == 0:
+            return X, Y, X, Y
+        return X[fit_ids], Y[fit_ids], X[score_ids], Y[score_ids]
+
     def fit(self, X, Y, W=None):
         self.K = len(set(Y))  # Class number
 
-        # Seed
+        # Seed. All randomness of the fit (projections, C candidates, base models) comes from self.random_state, global
+        # numpy generator is neither seeded nor used, so concurrent fits (e.g. k_fold with thread pool) do not interfere
         if self.seed is None:
             self.seed = np.random.randint(0, np.iinfo(np.int32).max)
-        else:
-            np.random.seed(self.seed)
-            # print("WARNING: seeding whole numpy (forced by bug in SVC)")
         self.random_state = np.random.RandomState(self.seed)
 
         # Models and scalers
@@ -208,26 +471,35 @@ class R2Learner(BaseEstimator):
         if not self.is_base_multiclass:
             raise NotImplementedError, "None base mutliclass models are deprecated."
 
-        if self.base_cls.func != LogisticRegression:
-            self.models_ = [self.base_cls().set_params(random_state=self.random_state) for _ in xrange(self.depth)]
-        else:
-            self.models_ = [self.base_cls() for _ in xrange(self.depth)]
+        if self.switched and self.base_cls.func != LogisticRegression:
+            raise NotImplementedError, "Only switching from LR to LinearSVC is supported"
 
-        if self.switched:
-            if self.base_cls.func != LogisticRegression:
-                raise NotImplementedError, "Only switching from LR to LinearSVC is supported"
-            self.models_[-1] = LinearSVC(loss='l1', C=1, class_weight='auto', random_state=self.random_state)
+        self.models_ = [self._make_model(last=(i == self.depth - 1)) for i in xrange(self.depth)]
 
+        # Passed projections are cast to dtype too (predict writes products into dtype buffers)
         if self.recurrent:
-            self.W = W if W else [[self.random_state.normal(size=(self.K, X.shape[1])) for _ in range(i+1)] \
-                                  for i in range(self.depth - 1)]
+            self.W = [[np.asarray(W_ij, dtype=self.dtype) for W_ij in W_i] for W_i in W] if W is not None else \
+                [[self.random_state.normal(size=(self.K, X.shape[1])).astype(self.dtype) \
+                  for _ in range(i+1)] for i in range(self.depth - 1)]
+            # W[i][j] stacked along rows, so sum_j o_j W[i][j] is one product with [o_0, .., o_i]
+            self.W_stacked_ = [np.vstack(W_i) for W_i in self.W]
         else:
-            self.W = W if W else [self.random_state.normal(size=(self.K, X.shape[1])) for _ in range(self.depth - 1)]
+            self.W = [np.asarray(W_i, dtype=self.dtype) for W_i in W] if W is not None else \
+                [self.random_state.normal(size=(self.K, X.shape[1])).astype(self.dtype) for _ in range(self.depth - 1)]
+
+        if self.profile:
+            self.profile_ = {'fit': [{} for _ in xrange(self.depth)], 'predict': []}
 
         # Prepare data
+        X = np.asarray(X, dtype=self.dtype)
         if self.scale:
-            X = self.scalers_[0].fit_transform(X)
+            with _phase(self._layer_profile('fit', 0), 'scaling') as p:
+                X = self.scalers_[0].fit_transform(X).astype(self.dtype, copy=False)
+                p['nbytes'] = X.nbytes
         self._fitted = False
+        self._prev_Cs = []
+        if self.layer_cache is not None:
+            self._layer_key = _array_digest(X) + _array_digest(Y) + str(self.K)
 
         # Fit
         for i in xrange(self.depth):
@@ -235,50 +507,184 @@ class R2Learner(BaseEstimator):
 
         return self
 
-    def predict(self, X, all_layers=False):
-        # Prepare data
-        if self.scale:
-            X = self.scalers_[0].transform(X)
+    def _make_model(self, last=False):
+        if last and self.switched:
+            return LinearSVC(loss='l1', C=1, class_weight='auto', random_state=self.random_state)
+        model = self.base_cls()
+        if 'random_state' in model.get_params():
+            # liblinear draws its seed from random_state (global numpy generator when None)
+            model.set_params(random_state=self.random_state)
+        return model
+
+    def _last_layer_differs(self):
+        # True if intermediate layers are not fitted the same way as the last one
+        return self.switched or self.fit_c in ['random_cls', 'random_cls_centered'] or \
+               (bool(self.fixed_prediction) and self.fit_c in ['random', 'random_exhaustive'])
+
+    def _truncated(self, k, last_model=None):
+        # Independent copy of first k layers, optionally with replaced last layer model
+        r2 = copy.copy(self)
+        r2.depth = k
+        r2.random_state = copy.deepcopy(self.random_state)
+        r2.models_ = copy.deepcopy(self.models_[0:k-1]) + \
+                     [copy.deepcopy(self.models_[k-1]) if last_model is None else last_model]
+        r2.scalers_ = copy.deepcopy(self.scalers_[0:k])
+        r2.W = copy.deepcopy(self.W[0:k-1])
+        if self.recurrent:
+            r2.W_stacked_ = copy.deepcopy(self.W_stacked_[0:k-1])
+        r2._o, r2._delta, r2._X_tr, r2._X_moved, r2._prev_Cs = [], [], [], [], []
+        if self.profile:
+            r2.profile_ = {'fit': self.profile_['fit'][0:k], 'predict': []}
+        return r2
 
-        _X = [X]
-        # Predict
-        for i in xrange(self.depth):
-            X = self._feed_forward(X, i)
-            if all_layers and i != self.depth-1: # Last layer is
-                _X.append(X)
+    def fit_all_depths(self, X, Y, W=None):
+        """
+        Fits the model once and returns list of fitted predictors of depth 1, .., self.depth
 
-        if all_layers:
-            return [m.predict(X_tr) for m, X_tr in zip(self.models_, _X)]
+        Predictor of depth k shares first k-1 layers with this model. Its last layer is the k-th layer of this model,
+        unless intermediate layers are fitted differently than the last one (fixed_prediction with fit_c, random_cls,
+        switched) - then a separate last layer is fitted on k-th representation. Random numbers are drawn in
+        different order than when fitting depth=k directly, so predictors match such fits in distribution, not bitwise.
+        """
+        self.fit(X, Y, W)
+
+        predictors = []
+        for k in xrange(1, self.depth):
+            if self._last_layer_differs():
+                prev_C, self._prev_C = self._prev_C, self._prev_Cs[k-1]
+                last_model = self._fit_layer(self._make_model(last=True), self._X_tr[k-1], Y, last=True,
+                                             prev_model=self.models_[k-2] if k > 1 else None)
+                self._prev_C = prev_C
+                predictors.append(self._truncated(k, last_model))
+            else:
+                predictors.append(self._truncated(k))
+        predictors.append(self._truncated(self.depth))
+
+        return predictors
+
+    def _layer_output(self, i, X):
+        # Prediction of i-th layer used to move the data, shape (n_samples, K)
+        if not self.fixed_prediction:
+            if self.K > 2:
+                return self.models_[i].decision_function(X).astype(self.dtype, copy=False)
+            d = self.models_[i].decision_function(X).reshape(-1, 1).astype(self.dtype, copy=False)
+            return np.hstack([-d, d])
+        elif isinstance(self.fixed_prediction, (int, long, float, complex)):
+            return np.ones(shape=(X.shape[0], self.K), dtype=self.dtype) * self.fixed_prediction
         else:
-            return self.models_[-1].predict(X)
+            raise NotImplementedError("self.fixed_prediction is wut?")
+
+    def _forward(self, X):
+        """
+        Stateless pass through fitted stack, yields (i, X_i) where X_i is the input of i-th layer model.
+
+        Nothing is stored on the estimator, so fitted model can be used from many threads at once. Representations
+        live in a few buffers allocated once per call and transformed in place, so memory does not grow with depth.
+        Consume X_i before advancing the generator - its buffer is reused by the next layers. With profile on,
+        profile_['predict'] of this call is recorded (so profiled model should not predict from many threads).
+        """
+        if self.profile:
+            # New dict, truncated copies of the model share the old one (loaded models have no fit profile)
+            self.profile_ = dict(getattr(self, 'profile_', {}), predict=[{} for _ in xrange(self.depth)])
+
+        with _phase(self._layer_profile('predict', 0), 'scaling') as p:
+            X = np.array(X, dtype=self.dtype)  # Private copy, scaled in place
+            if self.scale:
+                X *= self.scalers_[0].scale_
+                X += self.scalers_[0].min_
+            p['nbytes'] = X.nbytes
+
+        X_0 = X
+        moved = np.empty_like(X_0)
+        if self.recurrent:
+            o = np.empty(shape=(X.shape[0], self.K * (self.depth - 1)), dtype=self.dtype, order='F')
+
+        for i in xrange(self.depth):
+            yield i, X
+
+            if i == self.depth - 1:
+                break
+
+            profile = self._layer_profile('predict', i)
+            with _phase(profile, 'layer_output') as p:
+                output = self._layer_output(i, X)
+                p['nbytes'] = output.nbytes
+
+            with _phase(profile, 'projection'):
+                if self.recurrent:
+                    o[:, i*self.K:(i+1)*self.K] = output
+                    np.dot(o[:, 0:(i+1)*self.K], self.W_stacked_[i], out=moved)
+                else:
+                    np.dot(output, self.W[i], out=moved)
 
-    @staticmethod
-    def _tanh(x):
-        return 2. / (1. + np.exp(x)) - 1.
+            with _phase(profile, 'activation'):
+                moved *= self.beta
+                moved += X if self.use_prev else X_0
+                getattr(self, "_" + self.activation)(moved, out=moved)
 
-    @staticmethod
-    def _sigmoid(x):
-        return 1.0 / (1.0 + np.exp(-x))
+            if self.scale:
+                with _phase(profile, 'scaling'):
+                    moved *= self.scalers_[i + 1].scale_
+                    moved += self.scalers_[i + 1].min_
+
+            if profile is not None:
+                profile['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+            # Previous representation is not needed anymore (unless it is X_0 which we still move from)
+            X, moved = moved, (X if self.use_prev or X is not X_0 else np.empty_like(X_0))
+
+    def predict(self, X, all_layers=False):
+        if all_layers:
+            return [self._predict_layer(i, X_i) for i, X_i in self._forward(X)]
+
+        for i, X_i in self._forward(X):
+            if i == self.depth - 1:
+                return self._predict_layer(i, X_i)
 
-    @staticmethod
-    def _rbf(x):
-        return np.exp(-np.power((x - np.mean(x, axis=0)), 2))
+    def _predict_layer(self, i, X_i):
+        with _phase(self._layer_profile('predict', i), 'predict'):
+            return self.models_[i].predict(X_i)
 
-    @staticmethod
-    def _01_rbf(x):
-        return np.exp(-(np.power(x,2)/2))
+    # Called by getattr(self, "_" + self.activation), see activations.py
+    _tanh = staticmethod(activations.tanh)
+    _sigmoid = staticmethod(activations.sigmoid)
+    _rbf = staticmethod(activations.rbf)
+    _01_rbf = staticmethod(activations.rbf_01)
 
 
-def score_all_depths_r2(model, X, Y):
+def score_all_depths_r2(model, X, Y, metrics=None, decision_metrics=None):
     """
-    @returns depth, score_for_this_depth
+    Scores predictor of every depth in one pass through the stack, each layer's input is scored and dropped before
+    the next one is computed (memory does not grow with depth)
+
+    @param metrics dict name -> fnc(Y, Y_pred), e.g. {'acc': accuracy_score, 'f1': partial(f1_score, average='macro')}
+    @param decision_metrics dict name -> fnc(Y, decision) scored on decision_function of the layer model, e.g.
+        {'auc': roc_auc_score}
+    @returns accuracy of every depth, with metrics or decision_metrics list (one per depth) of dicts name -> score
     """
-    return [sklearn.metrics.accuracy_score(Y_pred, Y) for Y_pred in model.predict(X, all_layers=True)]
+    scores = []
+    for i, X_i in model._forward(X):
+        if metrics is None and decision_metrics is None:
+            scores.append(sklearn.metrics.accuracy_score(model._predict_layer(i, X_i), Y))
+            continue
+
+        layer_scores = {}
+        if metrics:
+            Y_pred = model._predict_layer(i, X_i)
+            for name, metric in metrics.iteritems():
+                layer_scores[name] = metric(Y, Y_pred)
+        if decision_metrics:
+            decision = model.models_[i].decision_function(X_i)
+            for name, metric in decision_metrics.iteritems():
+                layer_scores[name] = metric(Y, decision)
+        scores.append(layer_scores)
+    return scores
 
 class R2ELMLearner(R2Learner):
     def __init__(self, activation='sigmoid', recurrent=True, depth=10, \
                  seed=None, beta=0.1, scale=False, fit_c=None, use_prev=False, max_h=100, h=10,
-                 fit_h=None, C=100, fixed_prediction=False, switched=False):
+                 fit_h=None, C=100, fixed_prediction=False, switched=False, dtype=np.float64, fit_c_holdout=None,
+                 n_jobs=1, profile=False, layer_cache=None):
         """
         @param fixed_prediction pass float to fix prediction to this number or pass False to learn model
         """
@@ -286,18 +692,31 @@ class R2ELMLearner(R2Learner):
         self.max_h = max_h
 
         if fit_h == None:
-            base_cls = partial(ELM, h=self.h, activation='linear', C=C)
+            base_cls = partial(ELM, h=self.h, activation='linear', C=C, dtype=dtype)
         else:
             raise NotImplementedError()
 
         R2Learner.__init__(self, fixed_prediction=fixed_prediction, activation=activation, recurrent=recurrent, depth=depth, \
                            seed=seed, beta=beta, scale=scale, use_prev=use_prev, base_cls=base_cls,
-                           is_base_multiclass=True, fit_c=fit_c, C=C, switched=switched)
+                           is_base_multiclass=True, fit_c=fit_c, C=C, switched=switched, dtype=dtype,
+                           fit_c_holdout=fit_c_holdout, n_jobs=n_jobs, profile=profile, layer_cache=layer_cache)
+
+    def update(self, X, Y):
+        """
+        Folds new labeled batch into the last layer ELM (OS-ELM update, see ELM.update). Earlier layers, projections
+        and scalers stay as fitted, so the batch is only passed forward through them.
+        """
+        for i, X_i in self._forward(X):
+            if i == self.depth - 1:
+                self.models_[i].update(X_i, Y)
+
+        return self
 
 
 class R2SVMLearner(R2Learner):
     def __init__(self, activation='sigmoid', recurrent=True, depth=10, seed=None, beta=0.1, scale=False,
-                 fixed_prediction=False, use_prev=False, fit_c=None, C=1, use_linear_svc=True, switched=False):
+                 fixed_prediction=False, use_prev=False, fit_c=None, C=1, use_linear_svc=True, switched=False,
+                 dtype=np.float64, fit_c_holdout=None, n_jobs=1, profile=False, layer_cache=None):
         """
         @param fixed_prediction pass float to fix prediction to this number or pass False to learn model
         """
@@ -314,15 +733,149 @@ class R2SVMLearner(R2Learner):
 
             R2Learner.__init__(self, fixed_prediction=fixed_prediction, activation=activation, recurrent=recurrent, depth=depth, \
                                seed=seed, beta=beta, fit_c=fit_c, scale=scale, use_prev=use_prev, base_cls=base_cls,
-                               is_base_multiclass=True, switched=switched)
+                               is_base_multiclass=True, switched=switched, dtype=dtype, fit_c_holdout=fit_c_holdout,
+                               n_jobs=n_jobs, profile=profile, layer_cache=layer_cache)
 
 
 class R2LRLearner(R2Learner):
     def __init__(self, activation='sigmoid', recurrent=True, depth=10, seed=None, beta=0.1, scale=False, \
-                 fixed_prediction=False, use_prev=False, logger=None, fit_c=None, switched=False):
+                 fixed_prediction=False, use_prev=False, logger=None, fit_c=None, switched=False, dtype=np.float64,
+                 fit_c_holdout=None, n_jobs=1, profile=False, layer_cache=None):
 
         base_cls =  partial(LogisticRegression, fit_intercept=True)
 
         R2Learner.__init__(self, fixed_prediction=fixed_prediction, activation=activation, recurrent=recurrent, depth=depth, \
                                seed=seed, beta=beta, scale=scale, use_prev=use_prev, base_cls=base_cls, fit_c=fit_c,
-                               is_base_multiclass=True, switched=switched)
+                               is_base_multiclass=True, switched=switched, dtype=dtype, fit_c_holdout=fit_c_holdout,
+                               n_jobs=n_jobs, profile=profile, layer_cache=layer_cache)
+
+
+# Version of save_r2 files, increase on incompatible change
+R2_FORMAT_VERSION = 1
+
+
+def save_r2(model, path):
+    """
+    Writes fitted R2 model as uncompressed npz: layer models (as MyLinModel), projections W, scalers and json meta
+    with format version and constructor params. All arrays are raw .npy members, so load_r2 can memory-map them.
+    """
+    meta = {'format_version': R2_FORMAT_VERSION, 'class': type(model).__name__, 'K': model.K, 'layers': []}
+    meta['params'] = {}
+    for k in model._get_param_names():
+        # Params not kept as attributes (e.g. R2SVMLearner's use_linear_svc) get their defaults when loading
+        v = getattr(model, k, None)
+        if not hasattr(model, k):
+            continue
+        elif k == 'dtype':
+            meta['params'][k] = np.dtype(v).name
+        elif v is None or isinstance(v, (bool, int, long, float, basestring, np.number)):
+            meta['params'][k] = v.item() if isinstance(v, np.number) else v
+
+    arrays = {}
+    for i, m in enumerate(model.models_):
+        try:
+            m = _linear_layer(m)
+        except ValueError:
+            if model.fixed_prediction and i != model.depth - 1:
+                # Not fitted (fixed prediction with fit_c), not used for prediction
+                meta['layers'].append(None)
+                continue
+            raise
+        meta['layers'].append({'classes': m.classes is not None, 'threshold': m.threshold})
+        arrays['w_%d' % i], arrays['b_%d' % i] = m.w, np.atleast_1d(m.b)
+        if m.classes is not None:
+            arrays['classes_%d' % i] = np.asarray(m.classes)
+
+    if model.scale:
+        for i, scaler in enumerate(model.scalers_):
+            arrays['scale_%d' % i], arrays['min_%d' % i] = scaler.scale_, scaler.min_
+
+    for i, W in enumerate(model.W_stacked_ if model.recurrent else model.W):
+        arrays['W_%d' % i] = np.asarray(W)
+
+    arrays['meta'] = np.array(json.dumps(meta))
+
+    # Written next to target and renamed, so readers never see partial file
+    tmp_path = path + '.tmp' + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, path)
+
+
+def _load_npz(path, mmap_mode):
+    # Arrays of uncompressed npz, memory-mapped at offsets of their data inside the archive
+    arrays = {}
+    archive = zipfile.ZipFile(path)
+    members = archive.infolist()
+    archive.close()
+
+    with open(path, 'rb') as f:
+        for info in members:
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("Compressed member " + info.filename + " can not be memory-mapped")
+            # Local file header has 30 bytes, lengths of name and extra field are at 26 and 28
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject:
+                raise ValueError("Object arrays are not supported")
+
+            name = info.filename[0:-len('.npy')]
+            order = 'F' if fortran_order else 'C'
+            if mmap_mode is not None and int(np.prod(shape)) > 0 and name != 'meta':
+                arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, offset=f.tell(), shape=shape, order=order)
+            else:
+                arrays[name] = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape, order=order)
+    return arrays
+
+
+def load_r2(path, mmap_mode='r'):
+    """
+    Loads model written by save_r2. With mmap_mode (as in np.load) arrays are not read, but mapped from the file
+    (shared by all processes loading it), None reads them to memory.
+
+    @returns fitted model of the saved class with MyLinModel layers, supports predict (training state is not saved)
+    """
+    arrays = _load_npz(path, mmap_mode)
+    meta = json.loads(str(arrays['meta'][()]))
+    if meta['format_version'] > R2_FORMAT_VERSION:
+        raise ValueError("File format version %d is newer than supported %d" % (meta['format_version'],
+                                                                              R2_FORMAT_VERSION))
+
+    classes = {'R2Learner': R2Learner, 'R2ELMLearner': R2ELMLearner, 'R2SVMLearner': R2SVMLearner,
+               'R2LRLearner': R2LRLearner}
+    params = dict((str(k), v) for k, v in meta['params'].iteritems())
+    params['dtype'] = np.dtype(params['dtype']).type
+    model = classes[meta['class']](**params)
+
+    model.K = meta['K']
+    model.models_ = []
+    for i, layer in enumerate(meta['layers']):
+        if layer is None:
+            model.models_.append(None)
+            continue
+        model.models_.append(MyLinModel(arrays['w_%d' % i], arrays['b_%d' % i],
+                                        classes=arrays['classes_%d' % i] if layer['classes'] else None,
+                                        threshold=layer['threshold']))
+
+    model.scalers_ = []
+    if model.scale:
+        for i in xrange(model.depth):
+            scaler = MinMaxScaler((-1, 1))
+            scaler.scale_, scaler.min_ = arrays['scale_%d' % i], arrays['min_%d' % i]
+            model.scalers_.append(scaler)
+
+    W = [arrays['W_%d' % i] for i in xrange(model.depth - 1)]
+    if model.recurrent:
+        model.W, model.W_stacked_ = [], W
+    else:
+        model.W = W
+
+    model._fitted = True
+    return model
@@ -1,52 +1,26 @@
 import sys, os
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
-from sklearn.grid_search import GridSearchCV, ParameterGrid
-import numpy as np
-from multiprocessing import Pool
 from fit_models import extern_k_fold
 from data_api import *
+from misc.shared_data import publish_dataset
+from misc.scheduler import run_experiments
 from elm import ELM
-import time
-import traceback
 
 n_jobs = 8
 
 params = {'h': [i for i in xrange(20, 101, 20)],
-          'C': [10**i for i in xrange(0, 7)],
           'activation': ['sigmoid'],
           'random_state': [666]}
 
+# Whole C grid is fitted at once from one decomposition (ELM.fit_path)
+Cs = [10**i for i in xrange(0, 7)]
+
 datasets = fetch_new_datasets()
 datasets += fetch_small_datasets()
 datasets += fetch_medium_datasets()
+datasets = [publish_dataset(data) for data in datasets]  # workers get only mmap handles
 
-model = ELM()
-param_list = ParameterGrid(params)
-exp_name = 'test'
-
-def gen_params():
-    for data in datasets:
-        for param in param_list:
-            yield {'model': model, 'params': param, 'data': data, 'name': exp_name, 'model_name': 'elm'}
-
-params = list(gen_params())
-
-def run(p):
-    try:
-        extern_k_fold(base_model=p['model'], params=p['params'], data=p['data'], exp_name=p['name'], model_name=p['model_name'])
-    except Exception:
-            print p['model']
-            print traceback.format_exc()
-
-
-# for p in params:
-#     run(p)
+exp_params = [{'model': ELM, 'params': params, 'exp_name': 'test', 'model_name': 'elm'}]
 
-p = Pool(n_jobs)
-rs = p.map_async(run, params, 1)
-while True :
-    if (rs.ready()): break
-    remaining = rs._number_left
-    print "Waiting for", remaining, "tasks to complete for elm"
-    time.sleep(3)
\ No newline at end of file
+run_experiments(exp_params, datasets, extern_k_fold, n_jobs=n_jobs, runner_kwargs={'Cs': Cs})
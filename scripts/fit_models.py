@@ -4,15 +4,20 @@ from sklearn.metrics import accuracy_score
 from sklearn.preprocessing import MinMaxScaler, Normalizer
 from datetime import datetime
 import os, time, traceback, sys
+import hashlib
+import threading
 import numpy as np
 import scipy
 from sklearn.base import clone
-from copy import copy
+from copy import copy, deepcopy
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
-from misc.experiment_utils import save_exp, get_exp_logger, shorten_params, exp_done
+from misc.experiment_utils import save_exp, get_exp_logger, shorten_params, exp_done, get_exp_names
 from r2 import score_all_depths_r2, _r2_compress_model
+from elm import ELM
 from misc.data_api import shuffle_data
 
 def grid_search(model, data, param_grid, logger=None, scoring='accuracy', store_clf=False, n_jobs=8,
@@ -80,7 +85,106 @@ def grid_search(model, data, param_grid, logger=None, scoring='accuracy', store_
     save_exp(experiment)
 
 
-def k_fold(base_model, params, data, exp_name, model_name,  n_folds=5, seed=None, store_clf=False, log=True, n_tries=3, save_model=True, all_layers=True):
+# Splits of the last few datasets, shared by all grid points evaluated in this process (and its thread executors)
+_fold_cache = OrderedDict()
+_fold_cache_lock = threading.Lock()
+FOLD_CACHE_SIZE = 4
+
+
+def _data_digest(data):
+    # Published datasets are named by content digest already, others (e.g. shuffled copies sharing name and shape)
+    # are told apart by digest of their arrays
+    if getattr(data, 'data_path', None) is not None:
+        return data.data_path
+    digest = hashlib.sha1()
+    for array in [data.data, data.target]:
+        array = np.ascontiguousarray(array)
+        digest.update(str(array.dtype) + str(array.shape))
+        digest.update(array.view(np.uint8))
+    return digest.hexdigest()
+
+
+def get_folds(data, n_folds, seed, scale=False):
+    """
+    Stratified train/test splits of data as contiguous arrays, computed once per (dataset, n_folds, seed, scale)
+    in a process and reused afterwards (least recently used entries are dropped above FOLD_CACHE_SIZE). Thread safe,
+    concurrent calls for the same key compute it once
+
+    :param scale:   scale data to (-1, 1) by MinMaxScaler fitted on all of it before splitting
+    :return:        list of (X_train, X_test, Y_train, Y_test), must not be modified
+    """
+    key = (data.name, _data_digest(data), n_folds, seed, scale)
+
+    with _fold_cache_lock:
+        if key in _fold_cache:
+            folds = _fold_cache.pop(key)
+        else:
+            X, Y = data.data, data.target
+            if scale:
+                X = MinMaxScaler((-1,1)).fit_transform(X)
+            splits = StratifiedKFold(y=Y, n_folds=n_folds, shuffle=True, random_state=seed)
+            folds = [tuple(np.ascontiguousarray(A) for A in (X[train], X[test], Y[train], Y[test]))
+                     for train, test in splits]
+
+        _fold_cache[key] = folds
+        while len(_fold_cache) > FOLD_CACHE_SIZE:
+            _fold_cache.popitem(last=False)
+
+    return folds
+
+
+def _fit_and_score(task):
+    """
+    Fits and scores one (fold, seed) model of k_fold, module level so that process pools can pickle it
+
+    :return:    scores, train time, test time, compressed model(s) or None, profile_ of the model or None
+    """
+    base_model, fold_params, data, n_folds, seed, fold_id, all_layers, all_depths, store_clf = task
+    X_train, X_test, Y_train, Y_test = get_folds(data, n_folds, seed)[fold_id]
+
+    train_start = time.time()
+    model = base_model(**fold_params)
+    if all_depths:
+        depth_models = model.fit_all_depths(X_train, Y_train)
+    else:
+        model.fit(X_train, Y_train)
+    train_time = time.time() - train_start
+
+    test_start = time.time()
+    if all_depths:
+        scores = [accuracy_score(Y_test, m.predict(X_test)) for m in depth_models]
+    elif all_layers:
+        scores = score_all_depths_r2(model, X_test, Y_test)
+    else:
+        scores = accuracy_score(Y_test, model.predict(X_test))
+    test_time = time.time() - test_start
+
+    clf = None
+    if store_clf and all_depths:
+        clf = [_r2_compress_model(m) for m in depth_models]
+    elif store_clf:
+        clf = _r2_compress_model(model)
+
+    # Predictor of full depth has the fit profile of all layers and its own predict profile
+    profile = getattr(depth_models[-1] if all_depths else model, 'profile_', None)
+
+    return scores, train_time, test_time, clf, profile
+
+
+def k_fold(base_model, params, data, exp_name, model_name,  n_folds=5, seed=None, store_clf=False, log=True, n_tries=3, save_model=True, all_layers=True,
+           all_depths=False, executor=None, profile=False):
+    """
+    :param profile:     fit models with profile=True (R2Learner) and keep their per layer profile_ in
+                        monitors['profile'], one per (fold, seed) fit
+    :param executor:    object with map (e.g. multiprocessing Pool or ThreadPool) to run (fold, seed) fits
+                        concurrently, results are identical to the serial run. Process pools receive data by pickling,
+                        so pass published (memory-mapped) datasets. ThreadPool is accepted only for models with ELM
+                        layers (see _check_executor). Scheduler workers are daemonic and can not start process pools.
+    :param all_depths:  fit params['depth'] layers once (R2Learner.fit_all_depths) and score truncated predictor
+                        of every depth, returns (and saves) list of experiments, one per depth,
+                        same as separate all_layers=False runs, monitors which are not per depth (times, profile)
+                        are shared
+    """
 
     assert hasattr(data, 'name')
     assert hasattr(data, 'data')
@@ -89,6 +193,8 @@ def k_fold(base_model, params, data, exp_name, model_name,  n_folds=5, seed=None
     if seed is None:
         seed = params['seed']
 
+    _check_executor(executor, base_model, params)
+
     results = {}
     monitors = {}
     config = {}
@@ -99,13 +205,12 @@ def k_fold(base_model, params, data, exp_name, model_name,  n_folds=5, seed=None
     config['store_clf'] = store_clf
     config['params'] = params
 
-    short_params = shorten_params(params)
-
-    # change it!
-    config['experiment_name'] = exp_name + '_' + model_name + '_' + data.name + '_' + short_params
-    dir_name = exp_name + '_' + model_name + '_' + data.name
+    dir_name, config['experiment_name'] = get_exp_names(exp_name, model_name, data.name, params)
 
-    if save_model and exp_done(experiment, dir_name):
+    if save_model and all_depths and all(exp_done(E, dir_name) for E in _split_depths(experiment, dir_name)):
+        print "exp already done"
+        return
+    elif save_model and not all_depths and exp_done(experiment, dir_name):
         print "exp already done"
         return
 
@@ -114,71 +219,202 @@ def k_fold(base_model, params, data, exp_name, model_name,  n_folds=5, seed=None
     monitors["test_time"] = []
     monitors["clf"] = []
     monitors['fold_std'] = []
+    monitors['profile'] = []
 
     if log:
         logger = get_exp_logger(config, dir_name, to_file=True, to_std=False)
 
-    X, Y = data.data, data.target
-    folds = StratifiedKFold(y=Y, n_folds=n_folds, shuffle=True, random_state=seed)
+    tasks = _fold_tasks(base_model, dict(params, profile=True) if profile else params, data, n_folds, seed,
+                        xrange(n_folds), n_tries, all_layers, all_depths, store_clf)
+    fits = list((map if executor is None else executor.map)(_fit_and_score, tasks))
+    _add_fold_fits(monitors, fits, n_tries, store_clf)
 
-    for train_index, test_index in folds:
+    monitors['n_dim'] = data.n_dim
+    monitors['n_class'] = data.n_class
+    monitors['data_name'] = data.name
 
-        X_train, X_test, Y_train, Y_test = X[train_index], X[test_index], Y[train_index], Y[test_index]
+    monitors['fold_scores'] = np.array(monitors['fold_scores'])
 
-        fold_scores = []
-        fold_train_times = []
-        fold_test_times = []
+    if all_depths:
+        experiments = _split_depths(experiment, dir_name)
+        if log:
+            for E in experiments:
+                logger.info(E['config'])
+                logger.info(E['results'])
+        if save_model:
+            for E in experiments:
+                save_exp(E, dir_name)
+        return experiments
 
-        for seed_bias in xrange(n_tries):
-            fold_params = copy(params)
-            fold_params['seed'] += seed_bias
-            train_start = time.time()
-            model = base_model(**fold_params)
-            model.fit(X_train, Y_train)
-            fold_train_times.append(time.time() - train_start)
+    _set_k_fold_results(experiment, all_layers)
 
-            test_start = time.time()
+    if log:
+        logger.info(config)
+        logger.info(results)
+        logger.info(monitors)
 
-            if all_layers:
-                fold_scores.append(score_all_depths_r2(model, X_test, Y_test))
-            else:
-                Y_pred = model.predict(X_test)
-                fold_scores.append(accuracy_score(Y_test, Y_pred))
+    if save_model:
+        save_exp(experiment, dir_name)
 
-            fold_test_times.append(time.time() - test_start)
+    return experiment
 
-            if store_clf :
-                monitors['clf'].append(_r2_compress_model(model))
 
-        monitors['train_time'].append(fold_train_times)
-        monitors['test_time'].append(fold_test_times)
+def _check_executor(executor, base_model, params):
+    """
+    Raises ValueError for thread pool executor and model which can not be fitted in concurrent threads reproducibly:
+    liblinear (LinearSVC, LogisticRegression layers) seeds its solver through process global rand(), so concurrent
+    fits would interleave its draws. R2 models with ELM layers draw only from their own random_state.
+    """
+    if not isinstance(executor, ThreadPool):
+        return
+    model = base_model(**params)
+    base_cls = getattr(model, 'base_cls', None)
+    if getattr(base_cls, 'func', base_cls) is not ELM or getattr(model, 'switched', False):
+        raise ValueError("Fits of " + type(model).__name__ + " are not reproducible in threads, use process pool")
+
+
+def _fold_tasks(base_model, params, data, n_folds, seed, fold_ids, n_tries, all_layers, all_depths, store_clf):
+    # One task per (fold, seed), in the order of the serial loops, so merging does not depend on the executor
+    return [(base_model, dict(params, seed=params['seed'] + seed_bias), data, n_folds, seed, fold_id,
+             all_layers, all_depths, store_clf) for fold_id in fold_ids for seed_bias in xrange(n_tries)]
+
+
+def _add_fold_fits(monitors, fits, n_tries, store_clf):
+    """
+    Appends k_fold monitors of folds from _fit_and_score results (n_tries consecutive ones per fold)
+    """
+    for i in xrange(0, len(fits), n_tries):
+        fold_fits = fits[i:i + n_tries]
+        fold_scores = [scores for scores, _, _, _, _ in fold_fits]
+
+        monitors['train_time'].append([train_time for _, train_time, _, _, _ in fold_fits])
+        monitors['test_time'].append([test_time for _, _, test_time, _, _ in fold_fits])
         monitors['fold_scores'].append(np.mean(np.array(fold_scores), axis=0))
         monitors['fold_std'].append(np.std(np.array(fold_scores), axis=0))
+        if store_clf:
+            monitors['clf'] += [clf for _, _, _, clf, _ in fold_fits]
+        if any(profile is not None for _, _, _, _, profile in fold_fits):
+            monitors['profile'].append([profile for _, _, _, _, profile in fold_fits])
 
-    monitors['n_dim'] = data.n_dim
-    monitors['n_class'] = data.n_class
-    monitors['data_name'] = data.name
-
-    monitors['fold_scores'] = np.array(monitors['fold_scores'])
 
+def _set_k_fold_results(experiment, all_layers):
+    results, monitors = experiment['results'], experiment['monitors']
+    fold_scores = np.array(monitors['fold_scores'])
     if all_layers:
-        results['best_depth'] = np.argmax(np.mean(monitors['fold_scores'], axis=0)) + 1
-        results['mean_acc'] = np.max(np.mean(monitors['fold_scores'], axis=0))
+        results['best_depth'] = np.argmax(np.mean(fold_scores, axis=0)) + 1
+        results['mean_acc'] = np.max(np.mean(fold_scores, axis=0))
         results['std'] = np.mean(np.array(monitors['fold_std']), axis=0)[results['best_depth'] - 1]
     else:
-        results['mean_acc'] = monitors['fold_scores'].mean()
-        results['std'] = monitors['fold_scores'].std()
-        results['best_depth'] = params['depth']
+        results['mean_acc'] = fold_scores.mean()
+        results['std'] = fold_scores.std()
+        results['best_depth'] = experiment['config']['params']['depth']
 
-    if log:
-        logger.info(config)
-        logger.info(results)
-        logger.info(monitors)
 
-    if save_model:
-        save_exp(experiment, dir_name)
+def halving_k_fold(base_model, param_grid, data, exp_name, model_name, n_folds=5, seed=None, eta=3, min_folds=1,
+                   store_clf=False, log=True, n_tries=3, save_model=True, all_layers=True, executor=None):
+    """
+    Successive halving over param_grid: every configuration is evaluated on min_folds folds, only the best
+    1/eta of them continue on eta times more folds, and so on until the survivors are evaluated on all n_folds.
+    Scores of already evaluated folds are kept, so survivors end up with the same scores as in k_fold.
+
+    Every configuration gets (and saves) experiment in the format of k_fold computed from the folds it was evaluated
+    on, config['n_folds_evaluated'] says on how many. It is copied with config['search'] to results, so flat records
+    of load_results (and csv files of to_csv.py) tell partial estimates from full ones. Configurations are ranked by
+    results['mean_acc'].
+
+    :param param_grid:  grid (dict or list of dicts) as for ParameterGrid
+    :param executor:    as in k_fold, all fits of a round are mapped at once
+    :return:            list of experiments, configurations evaluated on more folds first, then best first
+    """
 
-    return experiment
+    assert hasattr(data, 'name')
+    assert hasattr(data, 'data')
+    assert hasattr(data, 'target')
+    assert eta > 1 and 1 <= min_folds <= n_folds
+
+    experiments = []
+    for params in ParameterGrid(param_grid):
+        _check_executor(executor, base_model, params)
+        config = {'n_folds': n_folds, 'seed': params['seed'] if seed is None else seed, 'store_clf': store_clf,
+                  'params': params, 'search': 'halving', 'eta': eta, 'n_folds_evaluated': 0}
+        dir_name, config['experiment_name'] = get_exp_names(exp_name, model_name, data.name, params)
+        monitors = {'fold_scores': [], 'train_time': [], 'test_time': [], 'clf': [], 'fold_std': [], 'profile': [],
+                    'n_dim': data.n_dim, 'n_class': data.n_class, 'data_name': data.name}
+        experiments.append({"config": config, "results": {}, "monitors": monitors})
+
+    if save_model and all(exp_done(E, dir_name) for E in experiments):
+        print "exp already done"
+        return
+
+    if log:
+        logger = get_exp_logger({'experiment_name': dir_name + '_halving'}, dir_name, to_file=True, to_std=False)
+
+    alive = experiments
+    n = min_folds
+    while True:
+        tasks, counts = [], []
+        for E in alive:
+            config = E['config']
+            E_tasks = _fold_tasks(base_model, config['params'], data, n_folds, config['seed'],
+                                  xrange(config['n_folds_evaluated'], n), n_tries, all_layers, False, store_clf)
+            tasks += E_tasks
+            counts.append(len(E_tasks))
+        fits = list((map if executor is None else executor.map)(_fit_and_score, tasks))
+
+        start = 0
+        for E, count in zip(alive, counts):
+            _add_fold_fits(E['monitors'], fits[start:start + count], n_tries, store_clf)
+            start += count
+            E['config']['n_folds_evaluated'] = n
+            _set_k_fold_results(E, all_layers)
+            E['results']['n_folds_evaluated'], E['results']['search'] = n, E['config']['search']
+
+        if log:
+            logger.info("%d configurations evaluated on %d folds, best mean_acc %f" %
+                        (len(alive), n, max(E['results']['mean_acc'] for E in alive)))
+
+        if n == n_folds:
+            break
+
+        # Stable sort, ties keep grid order
+        alive = sorted(alive, key=lambda E: -E['results']['mean_acc'])[0:max(1, len(alive) // eta)]
+        n = min(n_folds, n * eta)
+
+    experiments = sorted(experiments, key=lambda E: (-E['config']['n_folds_evaluated'], -E['results']['mean_acc']))
+
+    for E in experiments:
+        E['monitors']['fold_scores'] = np.array(E['monitors']['fold_scores'])
+        if log:
+            logger.info(E['config'])
+            logger.info(E['results'])
+        if save_model:
+            save_exp(E, dir_name)
+
+    return experiments
+
+
+def _split_depths(experiment, dir_name):
+    """
+    Splits experiment of k_fold(all_depths=True) into experiments of every depth 1..params['depth'], in the format
+    of k_fold(all_layers=False). Monitors which are not per depth (times) are shared. Works also on experiment
+    without monitors yet (to check which depths are done).
+    """
+    experiments = []
+    for d in xrange(1, experiment['config']['params']['depth'] + 1):
+        config = copy(experiment['config'])
+        config['params'] = dict(config['params'], depth=d)
+        config['experiment_name'] = dir_name + '_' + shorten_params(config['params'])
+        monitors = copy(experiment['monitors'])
+        results = {}
+        if len(monitors.get('fold_scores', [])):
+            monitors['fold_scores'] = np.array(monitors['fold_scores'])[:, d - 1]
+            monitors['fold_std'] = [std[d - 1] for std in monitors['fold_std']]
+            monitors['clf'] = [models[d - 1] for models in monitors['clf']]
+            results['mean_acc'] = monitors['fold_scores'].mean()
+            results['std'] = monitors['fold_scores'].std()
+            results['best_depth'] = d
+        experiments.append({"config": config, "results": results, "monitors": monitors})
+    return experiments
 
 
 def nk_folds(model, params, data, n=50, n_folds=10, n_jobs=4):
@@ -191,7 +427,12 @@ def nk_folds(model, params, data, n=50, n_folds=10, n_jobs=4):
 
     return np.mean(scores), np.std(scores)
 
-def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, seed=777, store_clf=False, log=True, save_model=True):
+def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, seed=777, store_clf=False, log=True, save_model=True,
+                  Cs=None):
+    """
+    :param Cs:  fit all C values at once with base_model.fit_path (ELM regularization path) and return (and save)
+                list of experiments, one per C, same as separate runs with params['C'] = C
+    """
 
     assert hasattr(data, 'name')
     assert hasattr(data, 'data')
@@ -207,12 +448,12 @@ def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, see
     config['store_clf'] = store_clf
     config['params'] = params
 
-    short_params = shorten_params(params)
+    dir_name, config['experiment_name'] = get_exp_names(exp_name, model_name, data.name, params)
 
-    config['experiment_name'] = exp_name + '_' + model_name + '_' + data.name + '_' + short_params
-    dir_name = exp_name + '_' + model_name + '_' + data.name
-
-    if save_model and exp_done(experiment, dir_name):
+    if save_model and Cs is not None and all(exp_done(E, dir_name) for E in _split_Cs(experiment, dir_name, Cs)):
+        print "exp already done"
+        return
+    elif save_model and Cs is None and exp_done(experiment, dir_name):
         print "exp already done"
         return
 
@@ -224,22 +465,22 @@ def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, see
     if log:
         logger = get_exp_logger(config, dir_name, to_file=True, to_std=False)
 
-    Y = data.target
-    X = MinMaxScaler((-1,1)).fit_transform(data.data)
-
-    folds = StratifiedKFold(y=Y, n_folds=n_folds, shuffle=True, random_state=seed)
-
-    for train_index, test_index in folds:
-        X_train, X_test, Y_train, Y_test = X[train_index], X[test_index], Y[train_index], Y[test_index]
+    for X_train, X_test, Y_train, Y_test in get_folds(data, n_folds, seed, scale=True):
         train_start = time.time()
         model = base_model(**params)
-        model.fit(X_train, Y_train)
+        if Cs is not None:
+            model.fit_path(X_train, Y_train, Cs)
+        else:
+            model.fit(X_train, Y_train)
         train_time = time.time() - train_start
 
         test_start = time.time()
-        Y_pred = model.predict(X_test)
+        if Cs is not None:
+            score = model.score_path(X_test, Y_test)
+        else:
+            Y_pred = model.predict(X_test)
+            score = accuracy_score(Y_test, Y_pred)
         test_time = time.time() - test_start
-        score = accuracy_score(Y_test, Y_pred)
 
         if store_clf :
             monitors['clf'].append(model)
@@ -255,6 +496,17 @@ def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, see
     monitors['n_class'] = data.n_class
     monitors['data_name'] = data.name
 
+    if Cs is not None:
+        experiments = _split_Cs(experiment, dir_name, Cs)
+        if log:
+            for E in experiments:
+                logger.info(E['config'])
+                logger.info(E['results'])
+        if save_model:
+            for E in experiments:
+                save_exp(E, dir_name)
+        return experiments
+
     results["mean_acc"] = monitors["acc_fold"].mean()
 
     if log:
@@ -267,3 +519,24 @@ def extern_k_fold(base_model, params, data, exp_name, model_name, n_folds=5, see
         save_exp(experiment, dir_name)
 
     return experiment
+
+
+def _split_Cs(experiment, dir_name, Cs):
+    """
+    Splits experiment of extern_k_fold(Cs=...) into experiments of every C, in the format of extern_k_fold.
+    Works also on experiment without monitors yet (to check which are done).
+    """
+    experiments = []
+    for j, C in enumerate(Cs):
+        config = copy(experiment['config'])
+        config['params'] = dict(config['params'], C=C)
+        config['experiment_name'] = dir_name + '_' + shorten_params(config['params'])
+        monitors = copy(experiment['monitors'])
+        results = {}
+        if len(monitors.get('acc_fold', [])):
+            monitors['acc_fold'] = monitors['acc_fold'][:, j]
+            monitors['std'] = monitors['acc_fold'].std()
+            monitors['clf'] = [deepcopy(m).set_C(C) for m in monitors['clf']]
+            results['mean_acc'] = monitors['acc_fold'].mean()
+        experiments.append({"config": config, "results": results, "monitors": monitors})
+    return experiments
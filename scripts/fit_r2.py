@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
-import sys, os, time, traceback
-from sklearn.grid_search import ParameterGrid
+import sys, os
 from multiprocessing import Pool
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from misc.experiment_utils import save_exp, get_exp_logger, shorten_params, exp_done
 from r2 import *
 from misc.data_api import *
+from misc.shared_data import publish_dataset
+from misc.scheduler import run_experiments
 from fit_models import *
 from elm import ELM
 
-datasets = fetch_all_datasets()
+datasets = [publish_dataset(data) for data in fetch_all_datasets()]  # workers get only mmap handles
 
 n_jobs = 2
 
+# 'grid' evaluates every configuration on all folds, 'halving' drops the worst ones after few folds
+# (fit_models.halving_k_fold, saved under exp_name 'halving')
+search = 'grid'
+
+# R2Learner layer cache shared by workers: grid points differing only in params of later layers (beta, use_prev, ..)
+# fit the common first layers once per (fold, seed), e.g. os.path.join(c["CACHE_DIR"], "r2_layers").
+# Entries are never evicted, so point it at a scratch dir and remove it after the run. None disables it
+layer_cache = None
+
 r2svm_params = {'beta': [0.1, 0.5, 1.0, 1.5, 2.0],
                 'fit_c': ['random', None],
                 'scale': [True, False],
@@ -30,35 +40,19 @@ r2elm_params = {'h': [i for i in xrange(20,101,20)],
                 'use_prev': [True, False],
                 'seed': [666]}
 
+if layer_cache is not None:
+    # Not in experiment names (shorten_params), results do not depend on it
+    for params in [r2svm_params, r2elm_params]:
+        params['layer_cache'] = [layer_cache]
+
 exp_params = [ {'model': R2SVMLearner, 'params': r2svm_params, 'exp_name': 'test', 'model_name': 'r2svm'},
               {'model': R2ELMLearner, 'params': r2elm_params, 'exp_name': 'test', 'model_name': 'r2elm'}]
 
 
-
-def gen_params():
+if search == 'halving':
+    pool = Pool(n_jobs)
     for data in datasets:
         for r in exp_params:
-            param_list = ParameterGrid(r['params'])
-            for param in param_list:
-                yield {'model': r['model'], 'params': param, 'data': data,
-                       'name': r['exp_name'], 'model_name': r['model_name']}
-
-params = list(gen_params())
-
-def run(p):
-    try:
-        k_fold(base_model=p['model'], params=p['params'], data=p['data'], exp_name=p['name'],
-           model_name=p['model_name'], all_layers=True)
-    except:
-        print p['model']
-        print traceback.format_exc()
-
-pool = Pool(n_jobs)
-rs = pool.map_async(run, params, 1)
-
-while True:
-    if rs.ready():
-        break
-    remaining = rs._number_left
-    print "Waiting for", remaining, "tasks to complete"
-    time.sleep(3)
+            halving_k_fold(r['model'], r['params'], data, 'halving', r['model_name'], all_layers=True, executor=pool)
+else:
+    run_experiments(exp_params, datasets, k_fold, n_jobs=n_jobs, runner_kwargs={'all_layers': True})
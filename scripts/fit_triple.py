@@ -1,22 +1,22 @@
 #!/usr/bin/env python
 
-import sys, os, time, traceback
-from sklearn.grid_search import ParameterGrid
-from multiprocessing import Pool
+import sys, os
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from misc.experiment_utils import save_exp, get_exp_logger, shorten_params, exp_done
 from r2 import *
 from misc.data_api import *
+from misc.shared_data import publish_dataset
+from misc.scheduler import run_experiments
 from fit_models import *
 from elm import ELM
 
-datasets = fetch_all_datasets(tripled=True)
+datasets = [publish_dataset(data) for data in fetch_all_datasets(tripled=True)]  # workers get only mmap handles
 
 n_jobs = 16
 
 fixed_r2svm_params = {'beta': [0.1, 0.5, 1.0, 1.5, 2.0],
-                      'depth': [i for i in xrange(1,11)],
+                      'depth': [10], # All depths 1..10 from single fit (k_fold all_depths=True)
                       'fit_c': ['random'],
                       'scale': [True, False],
                       'recurrent': [True, False],
@@ -26,31 +26,5 @@ fixed_r2svm_params = {'beta': [0.1, 0.5, 1.0, 1.5, 2.0],
 
 exp_params = [{'model': R2SVMLearner, 'params': fixed_r2svm_params, 'exp_name': 'triple_fixed', 'model_name': 'r2svm'}]
 
-def gen_params():
-    for data in datasets:
-        for r in exp_params:
-            param_list = ParameterGrid(r['params'])
-            for param in param_list:
-                yield {'model': r['model'], 'params': param, 'data': data,
-                       'name': r['exp_name'], 'model_name': r['model_name']}
-
-params = list(gen_params())
-
-def run(p):
-    try:
-        k_fold(base_model=p['model'], params=p['params'], data=p['data'], exp_name=p['name'],
-               model_name=p['model_name'], all_layers=False)
-
-    except:
-        print p['model']
-        print traceback.format_exc()
-
-pool = Pool(n_jobs)
-rs = pool.map_async(run, params, 1)
-
-while True:
-    if rs.ready():
-        break
-    remaining = rs._number_left
-    print "Waiting for", remaining, "tasks to complete"
-    time.sleep(3)
+run_experiments(exp_params, datasets, k_fold, n_jobs=n_jobs,
+                runner_kwargs={'all_layers': False, 'all_depths': True})
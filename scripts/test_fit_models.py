@@ -0,0 +1,145 @@
+"""
+Regression checks of fit_models.py, run by python -m unittest discover -s scripts (or pytest)
+"""
+
+import os, sys
+import shutil, tempfile
+import unittest
+import numpy as np
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from sklearn.datasets import make_classification
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fit_models
+from fit_models import get_folds, k_fold, halving_k_fold
+from misc import experiment_utils
+from misc.experiment_utils import load_results, get_exp_names
+from r2 import R2SVMLearner, R2ELMLearner
+
+
+class _Data(object):
+    # Fields of data_api datasets used by fit_models
+    def __init__(self, name, X, Y):
+        self.name, self.data, self.target = name, X, Y
+        self.n_dim, self.n_class = X.shape[1], len(set(Y))
+
+
+def _data(name='toy', seed=0):
+    X, Y = make_classification(120, 6, n_informative=3, n_classes=3, random_state=seed)
+    return _Data(name, X, Y)
+
+
+class TestFolds(unittest.TestCase):
+
+    def test_same_name_and_shape_different_contents(self):
+        data = _data()
+        perm = np.random.RandomState(1).permutation(len(data.target))
+        shuffled = _Data(data.name, data.data[perm], data.target[perm])
+
+        for scale in [False, True]:
+            folds = get_folds(data, 3, 0, scale=scale)
+            shuffled_folds = get_folds(shuffled, 3, 0, scale=scale)
+            self.assertFalse(any(np.array_equal(a[0], b[0]) for a, b in zip(folds, shuffled_folds)))
+            # Every test part comes from its own dataset
+            for X_train, X_test, Y_train, Y_test in shuffled_folds:
+                if not scale:
+                    self.assertTrue(all(any((row == shuffled.data).all(axis=1)) for row in X_test))
+
+    def test_folds_are_reused(self):
+        data = _data(seed=3)
+        self.assertIs(get_folds(data, 3, 0), get_folds(data, 3, 0))
+
+
+class TestExecutor(unittest.TestCase):
+
+    def _k_fold(self, model, params, data, executor=None):
+        return k_fold(model, params, data, 'test', 'test', n_folds=3, n_tries=2, log=False, save_model=False,
+                      executor=executor)['monitors']
+
+    def test_executor_results_equal_serial(self):
+        data = _data(seed=5)
+        for model, params, executor in [(R2ELMLearner, {'depth': 3, 'seed': 1, 'h': 10, 'fit_c': 'random'}, ThreadPool(3)),
+                                        (R2SVMLearner, {'depth': 3, 'seed': 1, 'fit_c': 'random'}, Pool(2))]:
+            serial = self._k_fold(model, params, data)
+            concurrent = self._k_fold(model, params, data, executor)
+            executor.close()
+            self.assertTrue(np.array_equal(serial['fold_scores'], concurrent['fold_scores']))
+            self.assertTrue(np.array_equal(serial['fold_std'], concurrent['fold_std']))
+
+    def test_concurrent_folds_of_one_dataset(self):
+        data = _data(seed=7)
+        fit_models._fold_cache.clear()
+        pool = ThreadPool(8)
+        folds = pool.map(lambda _: get_folds(data, 5, 0, scale=True), xrange(32))
+        self.assertTrue(all(f is folds[0] for f in folds))
+
+        # Every (fold, seed) task of k_fold reads the folds of the same dataset
+        fit_models._fold_cache.clear()
+        params = {'depth': 2, 'seed': 1, 'h': 10}
+        concurrent = k_fold(R2ELMLearner, params, data, 'test', 'test', n_folds=5, n_tries=3, log=False,
+                            save_model=False, executor=pool)['monitors']
+        pool.close()
+        serial = k_fold(R2ELMLearner, params, data, 'test', 'test', n_folds=5, n_tries=3, log=False,
+                        save_model=False)['monitors']
+        self.assertTrue(np.array_equal(serial['fold_scores'], concurrent['fold_scores']))
+
+    def test_thread_pool_refused_for_liblinear(self):
+        pool = ThreadPool(2)
+        self.assertRaises(ValueError, self._k_fold, R2SVMLearner, {'depth': 2, 'seed': 1}, _data(), pool)
+        pool.close()
+
+
+class TestAllDepths(unittest.TestCase):
+
+    def _k_fold(self, params, **kwargs):
+        return k_fold(R2SVMLearner, params, _data(seed=13), 'test', 'test', n_folds=3, n_tries=2, log=False,
+                      save_model=False, **kwargs)
+
+    def test_depth_experiments_equal_layer_scores(self):
+        for fit_c in [None, 'random']:
+            for fixed_prediction in [False, 1.0]:
+                params = {'depth': 4, 'seed': 1, 'fit_c': fit_c, 'fixed_prediction': fixed_prediction}
+                experiments = self._k_fold(params, all_depths=True)
+                self.assertEqual([E['config']['params']['depth'] for E in experiments], [1, 2, 3, 4])
+                self.assertEqual([E['results']['best_depth'] for E in experiments], [1, 2, 3, 4])
+
+                # Deepest predictor is the model itself
+                direct = self._k_fold(params, all_layers=False)
+                self.assertTrue(np.array_equal(experiments[-1]['monitors']['fold_scores'],
+                                               direct['monitors']['fold_scores']))
+                self.assertEqual(experiments[-1]['results']['mean_acc'], direct['results']['mean_acc'])
+
+                if fixed_prediction and fit_c is not None:
+                    continue  # Shallower last layers are fitted separately
+                layers = self._k_fold(params, all_layers=True)['monitors']['fold_scores']
+                for d, E in enumerate(experiments, 1):
+                    self.assertTrue(np.array_equal(E['monitors']['fold_scores'], layers[:, d - 1]))
+
+
+class TestHalving(unittest.TestCase):
+
+    def setUp(self):
+        self._results_dir = experiment_utils.c["RESULTS_DIR"]
+        experiment_utils.c["RESULTS_DIR"] = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(experiment_utils.c["RESULTS_DIR"])
+        experiment_utils.c["RESULTS_DIR"] = self._results_dir
+
+    def test_results_tell_partial_estimates(self):
+        data = _data(seed=11)
+        grid = {'depth': [2], 'seed': [1], 'h': [10], 'beta': [0.1, 0.5, 1.0]}
+        experiments = halving_k_fold(R2ELMLearner, grid, data, 'test', 'halving', n_folds=3, eta=3, n_tries=1,
+                                     log=False)
+
+        dir_name, _ = get_exp_names('test', 'halving', data.name, {})
+        records = load_results(dir_name)
+        self.assertEqual(len(records), 3)
+        self.assertEqual(sorted(r['n_folds_evaluated'] for r in records.itervalues()), [1, 1, 3])
+        self.assertTrue(all(r['search'] == 'halving' for r in records.itervalues()))
+        self.assertEqual(experiments[0]['results']['n_folds_evaluated'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,9 @@
 
 import sys, os
 sys.path.append('..')
-import cPickle
 import pandas as pd
 from misc.config import c
+from misc.experiment_utils import load_results
 results_dir = c['RESULTS_DIR']
 
 all_results = {}
@@ -19,20 +19,8 @@ paths = [ os.path.join(results_dir, model + '_' + dataset) for model in models f
 for path in paths:
     if os.path.isdir(path):
         print path
-        results = {}
-        for exp in os.listdir(path):
-            name = exp[:-11]
-            try:
-                exp_res = cPickle.load(open(os.path.join(path, exp),'r'))
-            except:
-                print exp
-                continue
-            merged_res = exp_res['monitors']
-            merged_res.update(exp_res['results'])
-            merged_res.update(exp_res['config']['params'])
-            results[name] = merged_res
         name = path.split('/')[-1]
-        all_results[name] = results
+        all_results[name] = load_results(name)
 
 for k, v in all_results.iteritems():
     pd.DataFrame.from_dict(v).transpose().to_csv(os.path.join(results_dir, 'csv', k))
@@ -0,0 +1,91 @@
+"""
+Regression checks of elm.py, run by python -m unittest discover (or pytest) from the repository root
+"""
+
+import unittest
+import numpy as np
+from sklearn.datasets import make_classification
+
+from elm import ELM
+
+
+def _data(n_samples=300, n_features=6, seed=0):
+    return make_classification(n_samples, n_features, n_informative=4, n_classes=3, random_state=seed)
+
+
+def _elm(**params):
+    return ELM(**dict({'h': 40, 'activation': 'sigmoid', 'random_state': 1, 'C': 10}, **params))
+
+
+class TestSolvers(unittest.TestCase):
+
+    def test_solvers_agree(self):
+        X, Y = _data()
+        for n in [30, 300]:  # dual solver is picked by 'auto' when n < h
+            expected = _elm(solver='cholesky').fit(X[:n], Y[:n]).decision_function(X)
+            for solver in ['dual', 'svd', 'auto']:
+                decision = _elm(solver=solver).fit(X[:n], Y[:n]).decision_function(X)
+                self.assertTrue(np.allclose(expected, decision, atol=1e-6), solver)
+
+
+class TestPath(unittest.TestCase):
+
+    def test_path_equals_separate_fits(self):
+        X, Y = _data()
+        Cs = [0.1, 1, 10, 1000]
+        model = _elm().fit_path(X[:200], Y[:200], Cs, X[200:], Y[200:])
+        for C, beta in zip(Cs, model.coef_path_):
+            self.assertTrue(np.allclose(_elm(C=C, solver='cholesky').fit(X[:200], Y[:200]).beta, beta, atol=1e-6))
+        best = np.argmax(model.val_scores_path_)
+        self.assertEqual(model.C, Cs[best])
+        self.assertTrue(np.array_equal(model.val_scores_path_, model.score_path(X[200:], Y[200:])))
+
+    def test_set_C(self):
+        X, Y = _data()
+        model = _elm(solver='svd').fit(X, Y).set_C(1000)
+        self.assertTrue(np.allclose(_elm(C=1000, solver='cholesky').fit(X, Y).beta, model.beta, atol=1e-6))
+        self.assertRaises(ValueError, _elm(solver='dual').fit(X, Y).set_C, 1000)
+
+
+class TestIncremental(unittest.TestCase):
+
+    def test_partial_fit_and_stream_equal_fit(self):
+        X, Y = _data()
+        expected = _elm(solver='cholesky').fit(X, Y).beta
+
+        model = _elm()
+        for i in xrange(0, X.shape[0], 70):
+            model.partial_fit(X[i:i+70], Y[i:i+70], classes=np.unique(Y))
+        self.assertTrue(np.allclose(expected, model.beta, atol=1e-6))
+
+        self.assertTrue(np.allclose(expected, _elm().fit_stream(X, Y, batch_size=70).beta, atol=1e-6))
+        chunks = [(X[i:i+70], Y[i:i+70]) for i in xrange(0, X.shape[0], 70)]
+        self.assertTrue(np.allclose(expected, _elm().fit_stream(chunks, classes=np.unique(Y)).beta, atol=1e-6))
+
+    def test_partial_fit_needs_classes(self):
+        X, Y = _data()
+        self.assertRaises(ValueError, _elm().partial_fit, X, Y)
+        self.assertRaises(ValueError, _elm(solver='dual').fit(X[:30], Y[:30]).partial_fit, X, Y)
+
+    def test_update_equals_fit(self):
+        X, Y = _data()
+        expected = _elm(solver='cholesky').fit(X, Y).beta
+        for solver in ['cholesky', 'svd']:
+            model = _elm(solver=solver).fit(X[:200], Y[:200])
+            model.update(X[200:250], Y[200:250]).update(X[250:], Y[250:])
+            self.assertTrue(np.allclose(expected, model.beta, atol=1e-6), solver)
+
+        # Normal equations are kept in sync by update
+        model = _elm(solver='cholesky').fit(X[:200], Y[:200]).update(X[200:250], Y[200:250])
+        model.partial_fit(X[250:], Y[250:])
+        self.assertTrue(np.allclose(expected, model.beta, atol=1e-6))
+
+    def test_update_refuses_unseen_classes(self):
+        X, Y = _data()
+        model = _elm(solver='cholesky').fit(X[Y != 2], Y[Y != 2])
+        self.assertRaises(ValueError, model.update, X[Y == 2], Y[Y == 2])
+        self.assertRaises(ValueError, _elm(solver='dual').fit(X[:30], Y[:30]).update, X, Y)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+"""
+Regression checks of r2.py, run by python -m unittest discover (or pytest) from the repository root
+"""
+
+import os, shutil, tempfile
+import unittest
+from functools import partial
+import numpy as np
+from sklearn.datasets import make_classification
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+
+import r2
+from r2 import R2Learner, R2SVMLearner, R2ELMLearner, R2LRLearner, save_r2, load_r2, score_all_depths_r2
+
+
+def _data(n_classes=3, n_samples=200, n_features=8, seed=0):
+    return make_classification(n_samples, n_features, n_informative=4, n_classes=n_classes, random_state=seed)
+
+
+# Activations as written before the in-place kernels of activations.py
+_reference_activations = {'sigmoid': lambda x: 1.0 / (1.0 + np.exp(-x)),
+                          'tanh': lambda x: 2. / (1. + np.exp(x)) - 1.,
+                          'rbf': lambda x: np.exp(-np.power((x - np.mean(x, axis=0)), 2)),
+                          '01_rbf': lambda x: np.exp(-(np.power(x, 2) / 2))}
+
+
+def _reference_inputs(model, X):
+    # Inputs of every layer model by a straightforward pass, fresh arrays and per block sum of recurrent projections
+    X = np.asarray(X, dtype=model.dtype)
+    if model.scale:
+        X = model.scalers_[0].transform(X).astype(model.dtype)
+    X_0, inputs, outputs = X, [], []
+    for i in xrange(model.depth):
+        inputs.append(X)
+        if i == model.depth - 1:
+            break
+        d = model.models_[i].decision_function(X)
+        outputs.append(d if model.K > 2 else np.hstack([-d.reshape(-1, 1), d.reshape(-1, 1)]))
+        if model.recurrent:
+            delta = sum(np.dot(o_j, model.W[i][j]) for j, o_j in enumerate(outputs))
+        else:
+            delta = np.dot(outputs[i], model.W[i])
+        X = _reference_activations[model.activation]((X if model.use_prev else X_0) + model.beta * delta)
+        if model.scale:
+            X = model.scalers_[i + 1].transform(X).astype(model.dtype)
+    return inputs
+
+
+class TestForward(unittest.TestCase):
+
+    def test_forward_equals_reference(self):
+        for n_classes in [2, 3]:
+            X, Y = _data(n_classes=n_classes)
+            X_test, Y_test = _data(n_classes=n_classes, seed=1)
+            for activation in ['sigmoid', 'tanh', 'rbf', '01_rbf']:
+                for recurrent in [True, False]:
+                    for use_prev in [True, False]:
+                        for scale in [True, False]:
+                            model = R2SVMLearner(depth=4, seed=1, beta=0.5, activation=activation, recurrent=recurrent,
+                                                 use_prev=use_prev, scale=scale).fit(X, Y)
+                            self._check(model, X, Y, X_test, Y_test)
+
+    def test_recurrent_delta_equals_block_sum(self):
+        X, Y = _data()
+        for dtype, tolerance in [(np.float64, 1e-8), (np.float32, 1e-4)]:
+            model = R2SVMLearner(depth=5, seed=1, beta=0.5, recurrent=True, dtype=dtype).fit(X, Y)
+            o = np.random.RandomState(0).normal(size=(X.shape[0], model.K * (model.depth - 1))).astype(dtype)
+            for i, W_i in enumerate(model.W):
+                stacked = np.dot(o[:, 0:(i+1)*model.K], model.W_stacked_[i])
+                block_sum = sum(np.dot(o[:, j*model.K:(j+1)*model.K], W_ij) for j, W_ij in enumerate(W_i))
+                self.assertEqual(stacked.dtype, dtype)
+                self.assertTrue(np.allclose(stacked, block_sum, rtol=tolerance, atol=tolerance))
+
+            ref = _reference_inputs(model, X)
+            for i, X_i in model._forward(X):
+                self.assertEqual(X_i.dtype, dtype)
+                self.assertTrue(np.allclose(X_i, ref[i], rtol=tolerance, atol=tolerance))
+
+    def _check(self, model, X, Y, X_test, Y_test):
+        # Fit path keeps training representations
+        for X_i, ref_i in zip(model._X_tr, _reference_inputs(model, X)):
+            self.assertTrue(np.allclose(X_i, ref_i))
+
+        for data, labels in [(X, Y), (X_test, Y_test)]:
+            ref = _reference_inputs(model, data)
+            for i, X_i in model._forward(data):
+                self.assertTrue(np.allclose(X_i, ref[i]))
+            predictions = [model.models_[i].predict(ref_i) for i, ref_i in enumerate(ref)]
+            self.assertTrue(np.array_equal(model.predict(data), predictions[-1]))
+            self.assertTrue(all(np.array_equal(a, b) for a, b in zip(model.predict(data, all_layers=True),
+                                                                     predictions)))
+            self.assertTrue(np.allclose(score_all_depths_r2(model, data, labels),
+                                        [accuracy_score(labels, p) for p in predictions]))
+
+
+class TestScoreAllDepths(unittest.TestCase):
+
+    def test_metrics_equal_per_depth_scores(self):
+        metrics = {'acc': accuracy_score, 'f1': partial(f1_score, average='macro')}
+        for n_classes, decision_metrics in [(2, {'auc': roc_auc_score}), (3, None)]:
+            X, Y = _data(n_classes=n_classes)
+            X_test, Y_test = _data(n_classes=n_classes, seed=1)
+            for model_cls, extra in [(R2SVMLearner, {}), (R2ELMLearner, {'h': 10})]:
+                model = model_cls(depth=4, seed=1, **extra)
+                predictors = model.fit_all_depths(X, Y)
+                scores = score_all_depths_r2(model, X_test, Y_test, metrics=metrics, decision_metrics=decision_metrics)
+                self.assertEqual(len(scores), model.depth)
+
+                for predictor, layer_scores in zip(predictors, scores):
+                    Y_pred = predictor.predict(X_test)
+                    self.assertEqual(layer_scores['acc'], accuracy_score(Y_test, Y_pred))
+                    self.assertEqual(layer_scores['f1'], f1_score(Y_test, Y_pred, average='macro'))
+                    if decision_metrics:
+                        decision = predictor.models_[-1].decision_function(_reference_inputs(predictor, X_test)[-1])
+                        self.assertTrue(np.allclose(layer_scores['auc'], roc_auc_score(Y_test, decision)))
+                    else:
+                        self.assertFalse('auc' in layer_scores)
+
+                self.assertEqual(score_all_depths_r2(model, X_test, Y_test),
+                                 [accuracy_score(Y_test, p.predict(X_test)) for p in predictors])
+
+
+class TestAllDepths(unittest.TestCase):
+
+    def test_truncated_equal_direct_fits(self):
+        X, Y = _data()
+        X_test = _data(seed=1)[0]
+        for model_cls, extra in [(R2SVMLearner, {}), (R2ELMLearner, {'h': 10})]:
+            for fit_c in [None, 'random']:
+                for fixed_prediction in [False, 1.0]:
+                    params = dict(extra, seed=1, fit_c=fit_c, fixed_prediction=fixed_prediction)
+                    W = model_cls(depth=4, **params).fit(X, Y).W
+                    predictors = model_cls(depth=4, **params).fit_all_depths(X, Y, W=W)
+                    self.assertEqual([p.depth for p in predictors], [1, 2, 3, 4])
+
+                    for k, predictor in enumerate(predictors, 1):
+                        direct = model_cls(depth=k, **params).fit(X, Y, W=W[0:k-1])
+                        for (_, X_i), (_, direct_X_i) in zip(predictor._forward(X_test), direct._forward(X_test)):
+                            self.assertTrue(np.array_equal(X_i, direct_X_i))
+                        # Intermediate models of fixed_prediction are not used (not fitted with fit_c)
+                        decision = predictor.models_[-1].decision_function(X_i)
+                        if fixed_prediction and fit_c is not None and k < 4:
+                            # Last layer is fitted separately, with other random numbers (C candidates) than the
+                            # direct fit, so only its quality is compared
+                            self.assertTrue(abs(accuracy_score(Y, predictor.predict(X)) -
+                                                accuracy_score(Y, direct.predict(X))) < 0.1)
+                        else:
+                            self.assertTrue(np.array_equal(decision, direct.models_[-1].decision_function(X_i)))
+                            if not fixed_prediction:
+                                self.assertTrue(np.array_equal(_decisions(predictor, X_test),
+                                                               _decisions(direct, X_test)))
+
+    def test_predictors_are_independent(self):
+        X, Y = _data()
+        model = R2SVMLearner(depth=4, seed=1, fit_c='random', fixed_prediction=1.0, scale=True)
+        predictors = model.fit_all_depths(X, Y)
+        predictions = [p.predict(X) for p in predictors]
+
+        for attr in ['models_', 'scalers_', 'W', 'W_stacked_']:
+            lists = [getattr(p, attr) for p in predictors] + [getattr(model, attr)]
+            self.assertEqual(len(set(map(id, lists))), len(lists))
+            self.assertEqual(len(set(map(id, sum(lists, [])))), sum(map(len, lists)))
+
+        # Refitting one of them (or the model) does not change the others
+        predictors[1].fit(*_data(seed=2))
+        model.fit(*_data(seed=3))
+        for k in [0, 2, 3]:
+            self.assertTrue(np.array_equal(predictions[k], predictors[k].predict(X)))
+
+
+class TestProjections(unittest.TestCase):
+
+    def test_passed_W_is_cast_to_dtype(self):
+        X, Y = _data()
+        for recurrent in [True, False]:
+            fitted = R2ELMLearner(depth=3, seed=1, recurrent=recurrent).fit(X, Y)
+            W = fitted.W  # float64
+
+            model = R2ELMLearner(depth=3, seed=1, recurrent=recurrent, dtype=np.float32).fit(X, Y, W=W)
+            W_list = sum(model.W, []) if recurrent else model.W
+            self.assertTrue(all(W_i.dtype == np.float32 for W_i in W_list))
+            self.assertEqual(model.predict(X).shape, Y.shape)
+
+
+def _decisions(model, X):
+    return np.hstack([model.models_[i].decision_function(X_i).ravel() for i, X_i in model._forward(X)])
+
+
+class TestLayerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_results_do_not_depend_on_cache(self):
+        X, Y = _data()
+        for model_cls, params in [(R2ELMLearner, {'h': 10, 'fit_c': 'random'}), (R2SVMLearner, {'fit_c': None})]:
+            for recurrent in [True, False]:
+                params = dict(params, depth=3, seed=1, recurrent=recurrent)
+                expected = _decisions(model_cls(**params).fit(X, Y), X)
+
+                cached = model_cls(layer_cache=self.dir, **params)
+                self.assertTrue(np.array_equal(expected, _decisions(cached.fit(X, Y), X)))
+                n_entries = len(os.listdir(self.dir))
+                self.assertTrue(n_entries > 0)
+
+                # Second fit is served from the cache, differing beta reuses the first layer
+                self.assertTrue(np.array_equal(expected, _decisions(cached.fit(X, Y), X)))
+                self.assertEqual(n_entries, len(os.listdir(self.dir)))
+                other = dict(params, beta=0.5)
+                self.assertTrue(np.array_equal(_decisions(model_cls(**other).fit(X, Y), X),
+                                               _decisions(model_cls(layer_cache=self.dir, **other).fit(X, Y), X)))
+            shutil.rmtree(self.dir)
+            os.mkdir(self.dir)
+
+
+class TestSaveLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.dir, 'model.npz')
+        for n_classes in [2, 3]:
+            X, Y = _data(n_classes=n_classes)
+            for model_cls in [R2SVMLearner, R2ELMLearner, R2LRLearner]:
+                for recurrent, scale in [(True, True), (False, False)]:
+                    model = model_cls(depth=3, seed=1, recurrent=recurrent, scale=scale).fit(X, Y)
+                    save_r2(model, path)
+                    for mmap_mode in ['r', None]:
+                        loaded = load_r2(path, mmap_mode=mmap_mode)
+                        self.assertEqual(type(loaded), model_cls)
+                        self.assertTrue(np.array_equal(model.predict(X), loaded.predict(X)))
+                        self.assertTrue(np.array_equal(model.predict(X, all_layers=True),
+                                                       loaded.predict(X, all_layers=True)))
+
+
+class TestCSearch(unittest.TestCase):
+
+    def _rare_class_data(self):
+        X, Y = _data()
+        keep = (Y != 2) | (np.cumsum(Y == 2) <= 3)  # 3 samples of class 2
+        return X[keep], Y[keep]
+
+    def test_holdout_split_keeps_every_class(self):
+        X, Y = self._rare_class_data()
+        model = R2ELMLearner(seed=1, fit_c_holdout=0.5)
+        model.random_state = np.random.RandomState(1)
+        X_fit, Y_fit, X_score, Y_score = model._holdout_split(X, Y)
+        self.assertEqual(set(Y_fit), set(Y))
+        self.assertEqual(len(Y_fit) + len(Y_score), len(Y))
+        for label in set(Y):
+            self.assertTrue(abs(np.mean(Y_score == label) - np.mean(Y == label)) < 0.05)
+
+    def test_holdout_with_rare_class(self):
+        X, Y = self._rare_class_data()
+        for model_cls, params in [(R2ELMLearner, {'h': 10}), (R2SVMLearner, {}), (R2LRLearner, {})]:
+            for holdout in [0.2, 0.9]:
+                model = model_cls(depth=3, seed=1, fit_c='random', fit_c_holdout=holdout, **params).fit(X, Y)
+                self.assertEqual(model.predict(X).shape, Y.shape)
+
+    def test_warm_start_only_with_honouring_solver(self):
+        X, Y = _data(n_classes=2)
+        fit_candidate = r2._fit_candidate
+        warm_starts = []
+
+        def recording_fit_candidate(candidate, *args):
+            warm_starts.append(candidate.get_params()['warm_start'])
+            return fit_candidate(candidate, *args)
+
+        r2._fit_candidate = recording_fit_candidate
+        try:
+            for solver, warm in [('liblinear', False), ('lbfgs', True)]:
+                del warm_starts[:]
+                model = R2Learner(depth=3, seed=1, fit_c='random', is_base_multiclass=True,
+                                  base_cls=partial(LogisticRegression, solver=solver)).fit(X, Y)
+                self.assertTrue(len(warm_starts) > 0)
+                self.assertTrue(all(w == warm for w in warm_starts))
+                self.assertTrue(all(not m.warm_start for m in model.models_))
+        finally:
+            r2._fit_candidate = fit_candidate
+
+if __name__ == '__main__':
+    unittest.main()